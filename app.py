@@ -9,18 +9,38 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 # Standard library imports
+import atexit
 import sys
 import traceback
-import inspect
 import fnmatch
+import getpass
 import multiprocessing
 import os
+import re
+import contextlib
+import gzip
+import hashlib
+import inspect
+import io
+import json
+import linecache
+import shutil
+import sqlite3
+import tempfile
 import threading
-from collections import deque
+import time
+import weakref
+from collections import deque, OrderedDict
+from functools import partial
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # Third party imports
 import sgtk
 from sgtk.platform import Application
+from tank_vendor.shotgun_api3 import Fault
 
 
 class TicketsApp(Application):
@@ -31,29 +51,141 @@ class TicketsApp(Application):
         sg_error (text): Error text (python traceback)
         sg_count (number): Number of times an error has occured
         sg_context (text): Context where the ticket was submitted from
+        sg_fingerprint (text): Normalized hash of an error's traceback
     '''
 
     def init_app(self):
-        # Import Tickets UI
-        self.ui = self.import_module("tickets_ui")
-        self.engine.register_command(
-            "Submit Ticket",
-            self.show_tickets_submitter,
-        )
+        start = time.time()
+        self._ui = None
+        self._spool = None
+        self._fingerprints = None
+        self._default_assignee = None
+        self._default_assignee_key = None
+        self._default_assignee_lock = threading.Lock()
+
+        # Farm and batch engines have no UI. In headless mode tickets_ui is
+        # never imported and Tickets are always created without a dialog.
+        self.headless = not self.engine.has_ui
+
+        # The Tickets UI is imported when it's first shown
+        if not self.headless:
+            self.engine.register_command(
+                "Submit Ticket",
+                self.show_tickets_submitter,
+            )
 
         # TicketsIO handles all IO operations for the Tickets App
         self.io = TicketsIO(self)
 
+        # Accumulates sg_count increments for known errors
+        self.counter = TicketsCounter(self)
+
+        # Background worker used to submit Tickets without blocking the host,
+        # replay spooled Tickets once Shotgun is reachable again and flush
+        # error counts.
+        self.submission_queue = TicketsSubmissionQueue(
+            self,
+            maxsize=self.get_setting('submission_queue_size', 32),
+        )
+        self.submission_queue.add_periodic(
+            self.replay_spool,
+            self.get_setting('spool_replay_interval', 60),
+        )
+        self.submission_queue.add_periodic(
+            self.counter.flush,
+            self.get_setting('count_flush_interval', 30),
+            on_stop=True,
+        )
+        # The worker is a daemon thread and destroy_app isn't called when an
+        # unhandled exception ends the interpreter, so drain it at exit too.
+        atexit.register(self.submission_queue.stop)
+
         # Install Tickets excepthook to deal with unhandled exceptions
         self.excepthook = TicketsExceptHook(self)
         self.excepthook.init()
+        self.submission_queue.add_periodic(
+            self.excepthook.report_suppressed,
+            10,
+            on_stop=True,
+        )
+
+        # Submit Tickets left in the spool by earlier sessions. The spool is
+        # only opened in the worker, replay_spool returns right away when
+        # it's empty.
+        self.submission_queue.put(self.replay_spool)
+
+        self.logger.debug(
+            'Initialized in %.2fms.' % ((time.time() - start) * 1000)
+        )
+
+    @property
+    def ui(self):
+        '''The tickets_ui module.
+
+        Imported on first use so that Qt and the frameworks it depends on
+        don't slow down engine startup.
+        '''
+
+        if self._ui is None:
+            self._ui = self.import_module("tickets_ui")
+        return self._ui
+
+    @property
+    def spool(self):
+        '''Tickets waiting to be submitted, see TicketsSpool.
+
+        Created on first use, so engine startup never touches the disk.
+        '''
+
+        if self._spool is None:
+            self._spool = TicketsSpool(
+                os.path.join(self.get_site_cache_dir(), 'spool')
+            )
+        return self._spool
+
+    @property
+    def fingerprints(self):
+        '''Error fingerprints shared by the processes on this host, see
+        TicketsFingerprints.
+
+        Created on first use, like the spool.
+        '''
+
+        if self._fingerprints is None:
+            self._fingerprints = TicketsFingerprints(
+                self.get_site_cache_dir() + '.db'
+            )
+        return self._fingerprints
+
+    def get_site_cache_dir(self):
+        '''Get a host-local directory for data of this Shotgun site.
+
+        SQLite locking isn't safe on network drives, where cache_location
+        may be.
+        '''
+
+        site = self.sgtk.shotgun_url.split('://')[-1].split('/')[0]
+        site = re.sub(r'[^\w.-]', '_', site)
+        return os.path.join(get_host_cache_dir(), site)
 
     def destroy_app(self):
         self.excepthook.destroy()
 
+        # Give queued Tickets and counts a chance to reach Shotgun before we
+        # exit
+        self.submission_queue.stop()
+        if hasattr(atexit, 'unregister'):
+            atexit.unregister(self.submission_queue.stop)
+
     def show_tickets_submitter(self, **field_defaults):
         '''Show the Ticket Submission dialog.'''
 
+        if self.headless:
+            self.logger.warning(
+                'Can not show the Tickets submitter in a headless engine.'
+            )
+            return
+
         field_defaults.setdefault('context', self.context)
         field_defaults.setdefault('assignee', self.get_default_assignee())
 
@@ -81,7 +213,10 @@ class TicketsApp(Application):
             Ticket
         '''
 
-        return self.excepthook.create_exception_ticket(typ, value, tb, confirm)
+        return self.excepthook.create_exception_ticket(
+            (typ, value, tb),
+            confirm,
+        )
 
     def create_ticket(
         self,
@@ -90,30 +225,51 @@ class TicketsApp(Application):
         attachments=None,
         error=None,
         exc_info=None,
+        progress=None,
     ):
         '''Create a new Ticket entity.
 
+        The Ticket is written to the spool before it's sent to Shotgun. When
+        Shotgun can not be reached the Ticket stays in the spool and is
+        submitted later by replay_spool.
+
         Arguments:
             fields (dict): Ticket data
             context (Context): Optional Context - defaults to current context
             extra_context (Context):
-            attachments (list): Optional files to attach to Ticket
+            attachments (list): Optional files to attach to Ticket. Either
+                file paths or (filename, data) tuples.
             error (str): Optional error string
-            exc_info (typ, value, tb): Optional Exception info
+            exc_info (ExceptionSnapshot): Optional Exception info. A
+                (typ, value, tb) tuple is converted to a snapshot.
+            progress (callable): Optional callback receiving the name of the
+                current stage ("create", "upload" or "notify") and for
+                uploads the number of done and total attachments.
 
         Return:
-            Ticket
+            Ticket or None if the Ticket was spooled for later submission.
         '''
 
         # Get Ticket Context
-        ticket_context = self._context_to_dict(context or self.context)
+        context = context or self.context
+        ticket_context = self._context_to_dict(context)
 
-        # Add traceback details and set error message
+        # Add traceback details, fingerprint and set error message. The
+        # traceback is formatted once, sg_error gets the truncated text.
+        full_error = error
         if exc_info:
-            tb_details = self.excepthook.get_traceback_details(exc_info[2])
+            exc_info = self.excepthook.snapshot(exc_info)
+            tb_details = self.excepthook.get_traceback_details(exc_info)
             ticket_context.update(tb_details)
+            fields['sg_fingerprint'] = exc_info.fingerprint
+            fields.setdefault('sg_count', 1)
             if not error:
-                error = self.excepthook.format_exception(*exc_info)
+                full_error = self.excepthook.format_exception(exc_info, 0)
+                error = truncate_text(
+                    full_error,
+                    self.excepthook.error_max_size,
+                )
+        formatted_error = error
 
         # Set project field
         project_id = context.project['id']
@@ -121,8 +277,7 @@ class TicketsApp(Application):
 
         # Call events_hook.before_create_ticket allowing users to augment
         # ticket data.
-        fields, ticket_context, error = self.execute_hook_method(
-            'events_hook',
+        fields, ticket_context, error = self.execute_events_hook(
             'before_create_ticket',
             fields=fields,
             context=ticket_context,
@@ -130,28 +285,320 @@ class TicketsApp(Application):
             exc_info=exc_info,
         )
 
+        # Keep sg_error small. When the error is too long it's truncated and
+        # the full error is attached compressed.
+        if error != formatted_error:
+            # Replaced by before_create_ticket
+            full_error = error
+        max_size = self.excepthook.error_max_size
+        if max_size and full_error and len(full_error) > max_size:
+            attachments = list(attachments or [])
+            attachments.append(('error.txt.gz', gzip_text(full_error)))
+            error = truncate_text(error, max_size)
+
         # Inject context and error message into fields
         fields['sg_context'] = code_block(self._format_context(ticket_context))
         fields['sg_error'] = code_block(error)
 
-        # Create our new ticket
+        # Spool the ticket so it's not lost if Shotgun is unreachable
+        try:
+            entry = self.spool.add(fields, attachments or [])
+        except (IOError, OSError, sqlite3.Error):
+            self.logger.warning(
+                'Failed to spool Ticket - submitting it directly.',
+                exc_info=True,
+            )
+            return self._create_ticket_directly(fields, attachments, progress)
+
+        try:
+            ticket = self._submit_spool_entry(
+                entry,
+                notify=False,
+                progress=progress,
+            )
+        except Fault:
+            # Shotgun rejected the ticket, retrying won't help
+            self.spool.remove(entry['id'])
+            raise
+        except Exception:
+            self.logger.warning(
+                'Failed to submit Ticket - it will be submitted later.',
+                exc_info=True,
+            )
+            self.spool.release(entry['id'])
+            return
+
+        # Some attachments failed to upload, leave them to replay_spool
+        if entry['attachments']:
+            self.spool.release(entry['id'])
+            return ticket
+
+        self._finish_spool_entry(entry)
+
+        # Send the notification in the background, there's no need to make
+        # the caller wait for it. If it fails, the entry stays in the spool
+        # and the notification is sent by replay_spool.
+        if progress:
+            progress('notify')
+        if not self.submission_queue.put(self._notify_spool_entries, [entry]):
+            self._notify_spool_entries([entry])
+        return ticket
+
+    def _create_ticket_directly(self, fields, attachments=None, progress=None):
+        '''Create a Ticket without the spool.
+
+        Used when the spool can't be written. Attachments that are missing
+        or fail to upload are skipped.
+        '''
+
+        if progress:
+            progress('create')
         ticket = self.io.create(fields)
 
+        tmp_dir = None
+        paths = []
+        try:
+            for attachment in attachments or []:
+                if isinstance(attachment, tuple):
+                    filename, data = attachment
+                    tmp_dir = tmp_dir or tempfile.mkdtemp()
+                    attachment = os.path.join(tmp_dir, filename)
+                    with open(attachment, 'wb') as f:
+                        f.write(data)
+                if os.path.isfile(attachment):
+                    paths.append(attachment)
+                else:
+                    self.logger.warning(
+                        'Attachment not found: %s' % attachment
+                    )
+
+            if paths:
+                failed = self.io.upload_attachments(
+                    ticket['id'],
+                    paths,
+                    progress=partial(progress, 'upload') if progress else None,
+                )
+                for attachment in failed:
+                    self.logger.warning(
+                        'Failed to upload attachment: %s' % attachment
+                    )
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if progress:
+            progress('notify')
+        self.send_ticket_notification(ticket)
+        self._ticket_created(ticket)
+        return ticket
+
+    def replay_spool(self, batch_size=10):
+        '''Submit Tickets that are waiting in the spool.
+
+        Tickets and their notifications are created in batches of
+        batch_size using one Shotgun request each per batch. Stops at the
+        first failure, leaving the remaining Tickets in the spool for the
+        next replay.
+        '''
+
+        while True:
+            entries = self.spool.claim(batch_size)
+            if not entries:
+                return
+
+            self.logger.debug('Replaying %s spooled Tickets.' % len(entries))
+            try:
+                new_entries = [e for e in entries if not e['ticket']]
+                if new_entries:
+                    self._create_spooled_tickets(new_entries)
+                entries = [e for e in entries if e['ticket']]
+                for entry in entries:
+                    self._submit_spool_entry(entry, notify=False)
+                    if entry['attachments']:
+                        self.spool.release(entry['id'])
+                entries = [e for e in entries if not e['attachments']]
+                if entries:
+                    self._notify_spool_entries(entries)
+            except Exception:
+                self.logger.warning(
+                    'Failed to replay spooled Tickets.',
+                    exc_info=True,
+                )
+                for entry in entries:
+                    self.spool.release(entry['id'])
+                return
+
+    def _create_spooled_tickets(self, entries):
+        '''Create Tickets for a batch of spool entries.
+
+        Entries that Shotgun rejects, or whose error already has a Ticket,
+        are removed from the spool and their ticket is left empty.
+        '''
+
+        entries = self._count_known_errors(entries)
+        if not entries:
+            return
+
+        try:
+            tickets = self.io.create_batch([e['fields'] for e in entries])
+        except Fault:
+            # A batch is a single transaction, so one invalid Ticket fails
+            # them all. Fall back to creating them one by one, storing each
+            # Ticket right away so a later failure doesn't create it twice.
+            for entry in entries:
+                try:
+                    ticket = self.io.create(entry['fields'])
+                except Fault:
+                    self.logger.exception(
+                        'Shotgun rejected spooled Ticket: %s' % entry['fields']
+                    )
+                    self.spool.remove(entry['id'])
+                    continue
+                entry['ticket'] = ticket
+                self.spool.set_ticket(entry['id'], ticket)
+            return
+
+        for entry, ticket in zip(entries, tickets):
+            entry['ticket'] = ticket
+            self.spool.set_ticket(entry['id'], ticket)
+
+    def _count_known_errors(self, entries):
+        '''Count spooled exception Tickets whose error already has a Ticket.
+
+        Exceptions are spooled without a Ticket lookup while Shotgun is
+        unreachable, so their error may have been reported in the meantime
+        or spooled more than once. Those entries are removed from the spool
+        and added to the count of the existing or first spooled Ticket.
+
+        Return:
+            Entries that still need a Ticket.
+        '''
+
+        fingerprints = [
+            entry['fields'].get('sg_fingerprint') for entry in entries
+        ]
+        if not any(fingerprints):
+            return entries
+
+        tickets = {}
+        for ticket in self.io.find_matching_errors(filter(None, fingerprints)):
+            tickets.setdefault(ticket['sg_fingerprint'], ticket)
+
+        new_entries = []
+        for entry, fingerprint in zip(entries, fingerprints):
+            ticket = tickets.get(fingerprint)
+            if not fingerprint or not (ticket or fingerprint in tickets):
+                # None marks fingerprints spooled earlier in this batch
+                tickets[fingerprint] = None
+                new_entries.append(entry)
+                continue
+
+            self.logger.debug('Counting spooled Ticket: %s' % fingerprint)
+            self.counter.add(fingerprint, entry['fields'].get('sg_count', 1))
+            if ticket:
+                self.excepthook.remember_ticket(fingerprint, ticket['id'])
+            self.spool.remove(entry['id'])
+        return new_entries
+
+    def _submit_spool_entry(self, entry, notify=True, progress=None):
+        '''Submit a spool entry, skipping any steps that already succeeded.
+
+        When notify is False, the entry stays in the spool until
+        _notify_spool_entries is called with it. Attachments that fail to
+        upload are left in entry['attachments'] and the notification is not
+        sent. See create_ticket for a description of progress.
+        '''
+
+        # Create our new ticket
+        ticket = entry['ticket']
+        if not ticket:
+            if progress:
+                progress('create')
+            ticket = self.io.create(entry['fields'])
+            entry['ticket'] = ticket
+            self.spool.set_ticket(entry['id'], ticket)
+
         # Upload our attachments
-        if attachments:
-            self.io.upload_attachments(ticket['id'], attachments)
+        if entry['attachments']:
+            upload_progress = partial(progress, 'upload') if progress else None
+            failed = self.io.upload_attachments(
+                ticket['id'],
+                entry['attachments'],
+                progress=upload_progress,
+            )
+            entry['attachments'] = failed
+            self.spool.set_attachments(entry['id'], failed)
+            if failed:
+                return ticket
 
-        # Create note to force notification to appear in Shotgun Inbox
-        self.send_ticket_notification(ticket)
+        if notify:
+            self._notify_spool_entries([entry])
+        return ticket
+
+    def _notify_spool_entries(self, entries):
+        '''Send notifications for submitted spool entries in one request.
+
+        Shotgun batches can't reference entities created earlier in the same
+        batch, so the Notes are sent once the Tickets exist.
+        '''
+
+        # Create notes to force notifications to appear in Shotgun Inbox
+        self.io.send_notifications([entry['ticket'] for entry in entries])
+
+        for entry in entries:
+            self.spool.remove(entry['id'])
+            if not entry['finished']:
+                self._ticket_created(entry['ticket'])
+
+    def _finish_spool_entry(self, entry):
+        '''Call after_create_ticket for an entry whose Ticket and attachments
+        were submitted.
+
+        The entry stays in the spool until its notification is sent. It's
+        marked finished first, so the hook is never called twice.
+        '''
+
+        entry['finished'] = True
+        self.spool.set_finished(entry['id'])
+        self._ticket_created(entry['ticket'])
+
+    def _ticket_created(self, ticket):
+        '''Called once a Ticket and its attachments were submitted.
+
+        Called from create_ticket, or from the submission_queue's worker for
+        Tickets submitted by replay_spool.
+        '''
+
+        # Repeats of this error can now be counted without a lookup
+        if ticket.get('sg_fingerprint'):
+            self.excepthook.remember_ticket(
+                ticket['sg_fingerprint'],
+                ticket['id'],
+            )
 
         # Call events_hook.after_create_ticket allowing users to perform
         # an action with the generated ticket data.
-        self.execute_hook_method(
-            'events_hook',
-            'after_create_ticket',
-            ticket=ticket,
-        )
-        return ticket
+        self.execute_events_hook('after_create_ticket', ticket=ticket)
+
+    def execute_events_hook(self, method_name, **kwargs):
+        '''Call an events_hook method in the main thread.
+
+        Hooks may use Qt, so when a Ticket is created from another thread,
+        like the Tickets dialog's submission thread, the hook is called in
+        the main thread. The submission_queue's worker calls hooks itself,
+        the main thread may be waiting for it to stop.
+        '''
+
+        in_background = not (self.headless or is_main_thread())
+        if in_background and not self.submission_queue.in_worker_thread:
+            return self.engine.execute_in_main_thread(
+                self.execute_hook_method,
+                'events_hook',
+                method_name,
+                **kwargs
+            )
+
+        return self.execute_hook_method('events_hook', method_name, **kwargs)
 
     def send_ticket_notification(self, ticket):
         '''Create a Note to force Tickets to show up in the Shotgun Inbox.'''
@@ -166,10 +613,38 @@ class TicketsApp(Application):
         )
 
     def get_default_assignee(self):
+        '''Get the default_assignee entity.
+
+        The entity is looked up once and cached until the default_assignee
+        setting or the app's context changes.
+        '''
+
         assignee = self.get_setting('default_assignee')
         if not assignee:
             return
 
+        key = (assignee['type'], assignee['id'], self.context)
+        with self._default_assignee_lock:
+            if key == self._default_assignee_key:
+                return self._default_assignee
+
+        entity = self._find_default_assignee(assignee)
+        with self._default_assignee_lock:
+            self._default_assignee = entity
+            self._default_assignee_key = key
+        return entity
+
+    def invalidate_default_assignee(self):
+        '''Clear the cached default_assignee entity.'''
+
+        with self._default_assignee_lock:
+            self._default_assignee = None
+            self._default_assignee_key = None
+
+    def post_context_change(self, old_context, new_context):
+        self.invalidate_default_assignee()
+
+    def _find_default_assignee(self, assignee):
         if assignee['type'] == 'Group':
             return self.shotgun.find_one(
                 assignee['type'],
@@ -230,15 +705,44 @@ class TicketsExceptHook(object):
 
     _is_tickets_excepthook = True
 
+    # Size and lifetime in seconds of the recent exceptions cache
+    recent_exceptions_size = 256
+    recent_exceptions_ttl = 3600
+
     def __init__(self, app):
         self.app = app
         self._default_excepthook = None
-        self._recent_exceptions = []
-        try:
-            import maya
-            self._host = 'maya'
-        except ImportError:
-            self._host = 'python'
+        self._default_threading_excepthook = None
+        self._asyncio_loops = weakref.WeakKeyDictionary()
+        self._module_names = {}
+        self._module_names_seeded = 0
+        self._matcher = None
+        self._legacy_filters = {}
+
+        # Maps fingerprints of recent exceptions to Ticket ids, or None when
+        # the Ticket is pending (dialog open or waiting in the spool).
+        self._recent_exceptions = LRUCache(
+            self.recent_exceptions_size,
+            self.recent_exceptions_ttl,
+        )
+
+        # Protects Shotgun and the host from crash storms
+        self.rate_limiter = TicketsRateLimiter(
+            rate=app.get_setting('excepthook_rate_limit', 1.0),
+            burst=app.get_setting('excepthook_rate_burst', 10),
+            error_rate=app.get_setting('excepthook_error_rate_limit', 0.1),
+            error_burst=app.get_setting('excepthook_error_rate_burst', 3),
+            cooldown=app.get_setting('excepthook_breaker_cooldown', 60),
+        )
+        # Batch Maya sessions use sys.excepthook like any other python
+        # interpreter, formatGuiException is only used by the Maya UI.
+        self._host = 'python'
+        if not app.headless:
+            try:
+                import maya
+                self._host = 'maya'
+            except ImportError:
+                pass
 
     @property
     def installed(self):
@@ -256,8 +760,14 @@ class TicketsExceptHook(object):
     def excludes(self):
         return self.app.get_setting('excepthook_excludes', [])
 
+    @property
+    def error_max_size(self):
+        return self.app.get_setting('error_max_size', 50000)
+
     @property
     def confirm(self):
+        if self.app.headless:
+            return False
         return self.app.get_setting('excepthook_confirm', True)
 
     def init(self):
@@ -266,7 +776,9 @@ class TicketsExceptHook(object):
         if self.enabled:
             self.app.logger.info('Init excepthook for %s...' % self._host)
             method = getattr(self, '_init_' + self._host)
-            return method()
+            method()
+            self._init_threading()
+            self._init_asyncio()
         else:
             self.app.logger.info('Skipping excepthook - disabled in settings.')
 
@@ -314,15 +826,92 @@ class TicketsExceptHook(object):
         # Install this object as the maya formatGuiException hook
         maya.utils.formatGuiException = self
 
+    def _init_threading(self):
+        '''Install threading.excepthook, available in python 3.8+.'''
+
+        if not hasattr(threading, 'excepthook'):
+            return
+
+        if is_tickets_excepthook(threading.excepthook):
+            self.app.logger.info('Threading excepthook already installed...')
+            return
+
+        self._default_threading_excepthook = threading.excepthook
+        threading.excepthook = self.threading_excepthook
+
+    def _init_asyncio(self):
+        '''Install the asyncio exception handler if a loop is running.'''
+
+        try:
+            import asyncio
+            loop = asyncio.get_running_loop()
+        except (ImportError, AttributeError, RuntimeError):
+            # No asyncio in python 2 or no loop running in this thread
+            return
+
+        self.install_asyncio(loop)
+
+    def install_asyncio(self, loop=None):
+        '''Create Tickets from unhandled exceptions of an asyncio loop.
+
+        Exceptions of Tasks and callbacks that are never retrieved are
+        passed to the loop's exception handler. The handler is replaced by
+        one that calls the original and then hands the exception off to the
+        submission_queue. Called by init for the loop running at the time.
+
+        Arguments:
+            loop: asyncio event loop. Defaults to the running loop or the
+                current thread's event loop.
+        '''
+
+        try:
+            import asyncio
+        except ImportError:
+            self.app.logger.debug('asyncio is not available.')
+            return
+
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except (AttributeError, RuntimeError):
+                loop = asyncio.get_event_loop()
+        default_handler = loop.get_exception_handler()
+        if is_tickets_excepthook(default_handler):
+            return
+
+        handler = partial(self.asyncio_exception_handler, default_handler)
+        handler._is_tickets_excepthook = True
+        loop.set_exception_handler(handler)
+        self._asyncio_loops[loop] = default_handler
+
     def destroy(self):
         '''Remove the TicketsExceptHook.'''
 
+        self._destroy_threading()
+        self._destroy_asyncio()
+
         if not self.installed:
             return
 
         method = getattr(self, '_destroy_' + self._host)
         return method()
 
+    def _destroy_threading(self):
+        '''Restore default threading.excepthook'''
+
+        if self._default_threading_excepthook is None:
+            return
+
+        threading.excepthook = self._default_threading_excepthook
+        self._default_threading_excepthook = None
+
+    def _destroy_asyncio(self):
+        '''Restore the default exception handlers of asyncio loops'''
+
+        for loop, default_handler in list(self._asyncio_loops.items()):
+            loop.set_exception_handler(default_handler)
+        self._asyncio_loops.clear()
+
     def _destroy_python(self):
         '''Restore default sys.excepthook'''
 
@@ -335,204 +924,1811 @@ class TicketsExceptHook(object):
         maya.utils.formatGuiException = self._default_excepthook
 
     def __call__(self, typ, value, tb, *extra):
-        '''Called when an unhandled exception occurs.'''
+        '''Called when an unhandled exception occurs.
+
+        Ticket creation is handed off to the app's submission_queue so that
+        the host application is never blocked by Shotgun round-trips. Only
+        an ExceptionSnapshot is queued, so the traceback, its frames and
+        their locals are released right away. Filtering and rate limiting
+        happen in the submission_queue, see create_exception_ticket.
+
+        In headless engines the Ticket is created before returning instead,
+        farm and batch processes usually exit right after an unhandled
+        exception in the main thread.
+        '''
 
         result = self._default_excepthook(typ, value, tb, *extra)
-        self.create_exception_ticket(typ, value, tb, self.confirm)
+        if self.app.headless and is_main_thread():
+            try:
+                self.create_exception_ticket((typ, value, tb))
+            except Exception:
+                self.app.logger.exception('Failed to submit Ticket.')
+            return result
+
+        self.handle(typ, value, tb)
         return result
 
+    def threading_excepthook(self, args):
+        '''Called when a thread raises an unhandled exception.
+
+        Installed as threading.excepthook in python 3.8+.
+        '''
+
+        self._default_threading_excepthook(args)
+
+        # Threads exit quietly on SystemExit
+        if args.exc_type is SystemExit:
+            return
+        self.handle(args.exc_type, args.exc_value, args.exc_traceback)
+
+    threading_excepthook._is_tickets_excepthook = True
+
+    def asyncio_exception_handler(self, default_handler, loop, context):
+        '''Called when an asyncio loop has an unhandled exception.
+
+        Installed by install_asyncio.
+        '''
+
+        if default_handler:
+            default_handler(loop, context)
+        else:
+            loop.default_exception_handler(context)
+
+        exception = context.get('exception')
+        if exception is not None:
+            self.handle(
+                type(exception),
+                exception,
+                exception.__traceback__,
+            )
+
+    def handle(self, typ, value, tb):
+        '''Hand an exception off to the submission_queue.
+
+        Only takes an ExceptionSnapshot and puts it in the queue, so it's
+        cheap to call from any thread. Module names, which may need the
+        filesystem, are resolved in the queue.
+        '''
+
+        snapshot = self.snapshot((typ, value, tb), resolve=False)
+
+        # Filters using the deprecated exception_filter(typ, value, tb)
+        # signature get the live exception, so they run before it's queued
+        filtered = False
+        if self.uses_legacy_exception_filter():
+            try:
+                if not self.filter_exception(snapshot, (typ, value, tb)):
+                    return
+            except Exception:
+                self.app.logger.exception('Failed to filter exception.')
+                return
+            filtered = True
+
+        queued = self.app.submission_queue.put(
+            self.create_exception_ticket,
+            snapshot,
+            self.confirm,
+            filtered,
+        )
+        if not queued:
+            self.app.logger.debug(
+                'Submission queue is full - skipping %s.' % snapshot.type_name
+            )
+            self.rate_limiter.suppress(None, snapshot.type_name)
+
     def _get_current_context(self):
         engine = sgtk.platform.current_engine()
         return engine.context
 
-    def create_exception_ticket(self, typ, value, tb, confirm=False):
+    def create_exception_ticket(self, exc_info, confirm=False, filtered=False):
+        '''Create a Ticket from an ExceptionSnapshot or exc_info tuple.
+
+        Exceptions rejected by events_hook.exception_filter are ignored,
+        pass filtered=True when the filter was already called.
+        When exceptions are raised faster than the rate limits allow, repeats
+        of errors with a known or pending Ticket are only counted and others
+        are skipped and listed in a summary Ticket by report_suppressed.
+        '''
+
+        snapshot = self.snapshot(exc_info)
+
         # Use events_hook.exception_filter to see if we should create a ticket
-        ticket_should_be_created = self.app.execute_hook_method(
-            'events_hook',
-            'exception_filter',
-            typ=typ,
-            value=value,
-            tb=tb,
-        )
-        if not ticket_should_be_created:
+        if not filtered and not self.filter_exception(snapshot, exc_info):
+            return
+        del exc_info
+
+        fingerprint = snapshot.fingerprint
+        if not self.rate_limiter.allow(fingerprint, snapshot.type_name):
+            if fingerprint in self._recent_exceptions:
+                self.app.counter.add(fingerprint)
+            return
+
+        # Count exceptions we've seen recently without querying Shotgun.
+        # Counts are flushed to the Ticket's sg_count field by the
+        # submission_queue.
+        if fingerprint in self._recent_exceptions:
+            self.app.logger.debug('Exception seen recently: %s' % fingerprint)
+            self.app.counter.add(fingerprint)
+            self.app.submission_queue.start()
+            return
+
+        # When another process on this host already handles the exception,
+        # it's only counted in the fingerprints table. The counts are flushed
+        # by whichever process flushes its counter first.
+        try:
+            claimed = self.app.fingerprints.claim(fingerprint)
+        except (OSError, sqlite3.Error):
+            self.app.logger.debug('Failed to claim fingerprint.', exc_info=1)
+            claimed = True
+        if not claimed:
+            # Only until the claim expires, in case the other process died
+            # before creating the Ticket.
+            self.app.logger.debug('Exception claimed by another process.')
+            self._recent_exceptions.set(
+                fingerprint,
+                None,
+                ttl=self.app.fingerprints.claim_timeout,
+            )
+            self.app.submission_queue.start()
             return
 
-        # Try to find a matching ticket for the traceback...
-        error = self.format_exception(typ, value, tb)
-        ticket = self.app.io.find_matching_error(error)
+        try:
+            return self._create_claimed_exception_ticket(snapshot, confirm)
+        except Exception:
+            # Don't keep the pending mark or the claim, so repeats aren't
+            # counted for a Ticket that doesn't exist
+            self.forget_ticket(fingerprint)
+            raise
+
+    def _create_claimed_exception_ticket(self, snapshot, confirm):
+        '''Find or create the Ticket of an exception this process claimed.'''
+
+        fingerprint = snapshot.fingerprint
+
+        # Try to find a matching ticket for the traceback. When Shotgun can't
+        # be reached, the Ticket is spooled and replay_spool looks for a
+        # matching Ticket before creating it.
+        try:
+            ticket = self.app.io.find_matching_error(fingerprint)
+        except Fault:
+            raise
+        except Exception:
+            self.app.logger.debug(
+                'Failed to look up matching Ticket.',
+                exc_info=True,
+            )
+            ticket = None
         if ticket:
-            # Log message and update Ticket's count field
             self.app.logger.debug('Found matching Ticket #%s' % ticket['id'])
-            count = (ticket['sg_count'] or 0) + 1
-            self.app.io.update(ticket['id'], {'sg_count': count})
+            self.remember_ticket(fingerprint, ticket['id'])
+            self.app.counter.add(fingerprint)
+            self.app.submission_queue.start()
             return
 
+        # Mark the Ticket as pending so repeats are only counted
+        self.remember_ticket(fingerprint, None)
+
         # Ticket fields
         fields = {
-            'title': '[unhandled] %s - %s ' % (typ.__name__, value),
+            'title': '[unhandled] %s - %s ' % (
+                snapshot.type_name,
+                snapshot.message,
+            ),
             'sg_ticket_type': 'Bug',
             'sg_priority': '3',
         }
-        assignee = self.app.get_default_assignee()
+        assignee = self.get_default_assignee()
         if assignee:
             fields['addressings_to'] = [assignee]
 
         # Show ticket dialog when excepthook_confirm is True
-        # or confirm was explicitly passed.
-        if confirm:
+        # or confirm was explicitly passed. We may be running in the
+        # submission_queue's worker thread, so the dialog is shown from the
+        # main thread.
+        if confirm and not self.app.headless:
             message = (
                 '<p style="color: #EB5757"><b>Unhandled Exception!</b></p>\n'
                 '<p>Please write a brief description of what you were '
                 'doing and submit a Ticket.</p>'
             )
-            return self.app.show_tickets_submitter(
+            return self.app.engine.async_execute_in_main_thread(
+                self.app.show_tickets_submitter,
                 title=fields['title'],
                 type=fields['sg_ticket_type'],
                 priority=fields['sg_priority'],
-                error=error,
+                error=self.format_exception(snapshot),
                 context=self._get_current_context(),
-                exc_info=(typ, value, tb),
+                exc_info=snapshot,
                 message=message,
-                assignee=self.app.get_default_assignee(),
+                assignee=assignee,
             )
 
         return self.app.create_ticket(
             fields,
             context=self.app.context,
-            error=error,
-            exc_info=(typ, value, tb),
+            exc_info=snapshot,
         )
 
-    def format_exception(self, typ, value, tb):
-        return ''.join(traceback.format_exception(typ, value, tb)).rstrip('\n')
+    def report_suppressed(self):
+        '''Create a summary Ticket once a crash storm is over.
 
-    def get_module_name(self, path):
-        '''Get the dotted path to the specified python file.'''
+        Called periodically by the submission_queue.
+        '''
 
-        def _get_module_name(path):
-            parts = [os.path.basename(path).rstrip('.py')]
-            path = os.path.dirname(os.path.abspath(path))
+        summary = self.rate_limiter.pop_summary()
+        if not summary:
+            return
 
-            while True:
-                if '__init__.py' in os.listdir(path):
-                    parent_name = os.path.basename(path)
-                    parts.append(parent_name)
-                    path = os.path.dirname(path)
-                else:
-                    break
+        count, duration, suppressed = summary
+        title = '[unhandled] %s exceptions suppressed in %d seconds' % (
+            count,
+            duration,
+        )
+        self.app.logger.warning(title)
+
+        lines = ['Rate limit exceeded. These exceptions were skipped:']
+        for (fingerprint, type_name), type_count in sorted(
+            suppressed.items(),
+            key=lambda item: -item[1],
+        ):
+            lines.append('  %s x %s (%s)' % (
+                type_count,
+                type_name,
+                fingerprint or 'submission queue full',
+            ))
 
-            return '.'.join(reversed(parts))
+        fields = {
+            'title': title,
+            'sg_ticket_type': 'Bug',
+            'sg_priority': '3',
+        }
+        assignee = self.get_default_assignee()
+        if assignee:
+            fields['addressings_to'] = [assignee]
 
-        try:
-            return _get_module_name(path)
-        except OSError:
-            pass
+        return self.app.create_ticket(
+            fields,
+            context=self.app.context,
+            error='\n'.join(lines),
+        )
 
-    def iter_traceback(self, tb):
-        '''Iterate over a traceback'''
+    def get_default_assignee(self):
+        '''Get the app's default_assignee entity.
 
-        while tb:
-            yield tb
-            tb = tb.tb_next
+        When Shotgun can't be reached, the entity is built from the
+        default_assignee setting, so the Ticket can still be spooled.
+        '''
 
-    def last(self, iterable):
-        '''Get the last item from an iterable'''
+        try:
+            return self.app.get_default_assignee()
+        except Fault:
+            raise
+        except Exception:
+            self.app.logger.debug(
+                'Failed to look up default assignee.',
+                exc_info=True,
+            )
 
-        return deque(iterable, maxlen=1)[0]
+        assignee = self.app.get_setting('default_assignee')
+        if assignee:
+            return {'type': assignee['type'], 'id': assignee['id']}
+
+    def remember_ticket(self, fingerprint, ticket_id):
+        '''Store the Ticket id of a recent exception.'''
+
+        self._recent_exceptions.set(fingerprint, ticket_id)
+        if ticket_id is None:
+            return
+
+        try:
+            self.app.fingerprints.set_ticket(fingerprint, ticket_id)
+        except (OSError, sqlite3.Error):
+            self.app.logger.debug('Failed to store fingerprint.', exc_info=1)
+
+    def forget_ticket(self, fingerprint):
+        '''Forget a pending exception so its next occurrence is handled.
+
+        Called when the Tickets dialog is closed without submitting, or when
+        the Ticket could not be created.
+        '''
+
+        if self._recent_exceptions.get(fingerprint, _missing) is None:
+            self._recent_exceptions.pop(fingerprint)
+
+        try:
+            self.app.fingerprints.release(fingerprint)
+        except (OSError, sqlite3.Error):
+            self.app.logger.debug('Failed to release fingerprint.', exc_info=1)
+
+    def uses_legacy_exception_filter(self):
+        '''Check if events_hook.exception_filter has the deprecated
+        exception_filter(typ, value, tb) signature.
+
+        The hook's signature is inspected once per events_hook setting.
+        '''
+
+        if not hasattr(self.app, 'create_hook_instance'):
+            # Older cores can't create the hook to inspect it
+            return False
+
+        hook_expression = self.app.get_setting('events_hook')
+        legacy = self._legacy_filters.get(hook_expression)
+        if legacy is None:
+            hook = self.app.create_hook_instance(hook_expression)
+            legacy = not accepts_argument(hook.exception_filter, 'exc_info')
+            self._legacy_filters[hook_expression] = legacy
+            if legacy:
+                self.app.logger.warning(
+                    'exception_filter(typ, value, tb) in %s is deprecated, '
+                    'override exception_filter(exc_info) instead.'
+                    % hook_expression
+                )
+        return legacy
+
+    def filter_exception(self, snapshot, exc_info=None):
+        '''Call events_hook.exception_filter.
+
+        Filters with the deprecated exception_filter(typ, value, tb)
+        signature are called with exc_info, a (typ, value, tb) tuple. When
+        exc_info is not available, the snapshot is unpacked instead, see
+        ExceptionSnapshot.__iter__.
+        '''
+
+        if self.uses_legacy_exception_filter():
+            typ, value, tb = exc_info or snapshot
+            return self.app.execute_hook_method(
+                'events_hook',
+                'exception_filter',
+                typ=typ,
+                value=value,
+                tb=tb,
+            )
+
+        return self.app.execute_hook_method(
+            'events_hook',
+            'exception_filter',
+            exc_info=snapshot,
+        )
+
+    def snapshot(self, exc_info, resolve=True):
+        '''Get an ExceptionSnapshot of a (typ, value, tb) tuple.
+
+        Snapshots are returned as is. Chained exceptions - __cause__ and
+        __context__ - are included in the snapshot.
+
+        Module names and the fingerprint may need filesystem lookups. With
+        resolve=False they are left empty, and added by the next call that
+        gets the snapshot.
+        '''
+
+        if isinstance(exc_info, ExceptionSnapshot):
+            if resolve and exc_info.fingerprint is None:
+                self._resolve(exc_info)
+            return exc_info
+
+        typ, value, tb = exc_info
+        snapshot = ExceptionSnapshot(
+            typ,
+            value,
+            TracebackSummary.from_traceback(tb),
+        )
+
+        # Python 3 exception chains
+        seen = set([id(value)])
+        last = snapshot
+        while True:
+            cause = getattr(value, '__cause__', None)
+            message = ExceptionSnapshot.direct_cause_message
+            if cause is None and not getattr(value, '__suppress_context__', 0):
+                cause = getattr(value, '__context__', None)
+                message = ExceptionSnapshot.context_message
+            if cause is None or id(cause) in seen:
+                break
+
+            seen.add(id(cause))
+            last.cause = ExceptionSnapshot(
+                type(cause),
+                cause,
+                TracebackSummary.from_traceback(cause.__traceback__),
+            )
+            last.cause_message = message
+            last = last.cause
+            value = cause
+
+        if resolve:
+            self._resolve(snapshot)
+        return snapshot
+
+    def _resolve(self, snapshot):
+        '''Add module names and the fingerprint to a new snapshot.'''
+
+        cause = snapshot
+        while cause:
+            summary = cause.summary
+            if summary.frames and summary.module is None:
+                summary.module = self.get_module_name(summary.filename)
+            cause = cause.cause
+
+        # Like get_type_name
+        type_name = snapshot.type_name
+        type_module = snapshot.type_module
+        if type_module not in ('builtins', 'exceptions', '__builtin__'):
+            type_name = type_module + '.' + type_name
+        snapshot.fingerprint = self._get_fingerprint(
+            type_name,
+            snapshot.summary,
+        )
+
+    def format_exception(self, exc_info, max_size=None):
+        '''Format an ExceptionSnapshot like traceback.format_exception.
+
+        Repeated frames of recursive calls are collapsed and the text is
+        truncated to max_size characters, defaulting to error_max_size.
+        Pass 0 to get the full text.
+        '''
+
+        if max_size is None:
+            max_size = self.error_max_size
+        return truncate_text(self.snapshot(exc_info).format(), max_size)
+
+    def get_fingerprint(self, typ, value, tb):
+        '''Get a short stable hash identifying an exception.
+
+        The hash covers the exception type and the module and function of
+        each frame in the traceback. Line numbers, memory addresses and temp
+        paths are left out, so the same error raised from slightly different
+        code or sessions produces the same fingerprint.
+        '''
+
+        return self._get_fingerprint(get_type_name(typ), self.summarize(tb))
+
+    def _get_fingerprint(self, type_name, summary):
+        parts = [normalize_fingerprint_part(type_name)]
+        for filename, _, function, module in summary.frames:
+            # tk-core imports bundles and hooks under random module names,
+            # use the name derived from the file's path instead
+            if not module or _volatile_module_name.match(module):
+                module = None
+                if not filename.startswith('<'):
+                    module = self.get_module_name(filename)
+                if not module:
+                    module = os.path.splitext(os.path.basename(filename))[0]
+            part = normalize_fingerprint_part(module + ':' + function)
+
+            # Recursion depth doesn't change the fingerprint
+            if part != parts[-1]:
+                parts.append(part)
+
+        data = '\n'.join(parts).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def summarize(self, tb):
+        '''Get a TracebackSummary of a traceback or ExceptionSnapshot.'''
+
+        if isinstance(tb, ExceptionSnapshot):
+            return self.snapshot(tb).summary
+
+        summary = TracebackSummary.from_traceback(tb)
+        if summary.frames:
+            summary.module = self.get_module_name(summary.filename)
+        return summary
+
+    def get_module_name(self, path):
+        '''Get the dotted path to the specified python file.
+
+        Results are cached by path. The cache is seeded from the __file__ of
+        the modules in sys.modules, so most paths resolve without touching
+        the filesystem.
+        '''
+
+        key = get_module_path_key(path)
+        try:
+            return self._module_names[key]
+        except KeyError:
+            pass
+
+        if self._module_names_seeded != len(sys.modules):
+            self._seed_module_names()
+            if key in self._module_names:
+                return self._module_names[key]
+
+        name = self._find_module_name(path)
+        self._module_names[key] = name
+        return name
+
+    def _seed_module_names(self):
+        '''Add the files of all modules in sys.modules to the cache.
+
+        Only names that _find_module_name would give the file are added.
+        Aliases like __main__ and __mp_main__, and modules imported under
+        generated names, like tk-core's bundles and hooks, are left to
+        _find_module_name.
+        '''
+
+        modules = list(sys.modules.items())
+        for name, module in modules:
+            path = getattr(module, '__file__', None)
+            if not path or name in ('__main__', '__mp_main__'):
+                continue
+
+            key = get_module_path_key(path)
+            if key in self._module_names:
+                continue
+
+            if not self._is_path_module_name(name, path):
+                continue
+
+            # Match the names given by _find_module_name to packages
+            if os.path.basename(os.path.splitext(path)[0]) == '__init__':
+                name += '.__init__'
+            self._module_names[key] = name
+        self._module_names_seeded = len(modules)
+
+    def _is_path_module_name(self, name, path):
+        '''Check if name is the module name _find_module_name finds.'''
+
+        parts = name.split('.')
+        path_parts = os.path.splitext(os.path.abspath(path))[0]
+        path_parts = path_parts.replace('\\', '/').split('/')
+        if path_parts[-1] == '__init__':
+            path_parts.pop()
+        if path_parts[-len(parts):] != parts:
+            return False
+
+        # Parent packages must be regular packages with an __init__.py
+        for i in range(1, len(parts)):
+            parent = sys.modules.get('.'.join(parts[:i]))
+            if not getattr(parent, '__file__', None):
+                return False
+
+        # _find_module_name would include a parent package
+        root = '/'.join(path_parts[:-len(parts)])
+        return not os.path.isfile(os.path.join(root, '__init__.py'))
+
+    def _find_module_name(self, path):
+        '''Find a module name by looking for __init__.py files.'''
+
+        def _get_module_name(path):
+            parts = [os.path.splitext(os.path.basename(path))[0]]
+            path = os.path.dirname(os.path.abspath(path))
+
+            while True:
+                if '__init__.py' in os.listdir(path):
+                    parent_name = os.path.basename(path)
+                    parts.append(parent_name)
+                    path = os.path.dirname(path)
+                else:
+                    break
+
+            return '.'.join(reversed(parts))
+
+        try:
+            return _get_module_name(path)
+        except OSError:
+            pass
+
+    def iter_traceback(self, tb):
+        '''Iterate over a traceback'''
+
+        while tb:
+            yield tb
+            tb = tb.tb_next
+
+    def last(self, iterable):
+        '''Get the last item from an iterable'''
+
+        return deque(iterable, maxlen=1)[0]
 
     def is_important_traceback(self, tb, includes=None, excludes=None):
         '''Is the traceback important?
 
         Called by the default events_hook.excepton_filter to determine if a
         Ticket should be created.
+
+        Arguments:
+            tb: Traceback or ExceptionSnapshot
+            includes (list): Module name patterns to include
+            excludes (list): Module name patterns to exclude
         '''
 
-        tb = self.last(self.iter_traceback(tb))
-        frame = tb.tb_frame
-        frame_info = inspect.getframeinfo(frame)
-        tb_module = self.get_module_name(frame_info.filename)
+        tb_module = self.summarize(tb).module
+        return self.get_matcher(includes, excludes).match(tb_module)
 
-        if excludes:
-            for pattern in excludes:
-                if fnmatch.fnmatch(tb_module, pattern):
-                    return False
+    def get_matcher(self, includes=None, excludes=None):
+        '''Get a ModuleMatcher for includes and excludes patterns.
 
-        if includes:
-            for pattern in includes:
-                if fnmatch.fnmatch(tb_module, pattern):
-                    return True
+        The last matcher is reused until the patterns change.
+        '''
 
-        return False
+        includes = includes or []
+        excludes = excludes or []
+        matcher = self._matcher
+        if matcher is None or not matcher.has_patterns(includes, excludes):
+            matcher = ModuleMatcher(includes, excludes)
+            self._matcher = matcher
+        return matcher
 
     def get_traceback_details(self, tb):
-        '''Get valuable details from a Traceback.'''
+        '''Get valuable details from a Traceback or ExceptionSnapshot.'''
+
+        summary = self.summarize(tb)
+        return {
+            'filename': summary.filename.replace('\\', '/'),
+            'module': summary.module,
+            'thread': summary.thread,
+            'threadName': summary.thread_name,
+            'process': summary.process,
+            'processName': summary.process_name,
+            'lineno': summary.lineno,
+            'funcName': summary.function,
+            'culprit': summary.module + '.' + summary.function,
+        }
+
+
+class ModuleMatcher(object):
+    '''Matches module names against include and exclude wildcard patterns.
+
+    All patterns are compiled into a single regular expression, so a module
+    name is matched once no matter how many patterns there are. Excludes
+    take precedence over includes.
+    '''
+
+    def __init__(self, includes, excludes):
+        self.includes = includes
+        self.excludes = excludes
+        self._key = (tuple(includes), tuple(excludes))
+
+        groups = []
+        if excludes:
+            groups.append('(?P<exclude>%s)' % self._join(excludes))
+        if includes:
+            groups.append('(?P<include>%s)' % self._join(includes))
+
+        # Match fnmatch's case sensitivity on this platform
+        flags = 0
+        if os.path.normcase('A') == 'a':
+            flags = re.IGNORECASE
+        self._regex = re.compile('|'.join(groups), flags) if groups else None
 
-        last_tb = self.last(self.iter_traceback(tb))
-        frame = last_tb.tb_frame
-        frame_info = inspect.getframeinfo(frame)
-        module = self.get_module_name(frame_info.filename)
+    def _join(self, patterns):
+        return '|'.join(fnmatch.translate(p) for p in patterns)
+
+    def has_patterns(self, includes, excludes):
+        '''Check if this matcher was built from the given patterns.'''
+
+        if includes is self.includes and excludes is self.excludes:
+            return True
+        return self._key == (tuple(includes), tuple(excludes))
+
+    def match(self, module):
+        '''Return True if module is included and not excluded.'''
+
+        if not self._regex or not module:
+            return False
+
+        match = self._regex.match(module)
+        return bool(match and match.group('include') is not None)
+
+
+class ExceptionSnapshot(object):
+    '''Compact, picklable copy of an exception.
+
+    Holds everything needed to filter, fingerprint and format an exception
+    without keeping the exception, its traceback, frames or their locals
+    alive. Source lines are only read from linecache when formatting.
+    Messages are truncated to max_message_size characters.
+
+    Attributes:
+        type (type): The exception class, None once unpickled
+        type_name (str): Name of the exception class
+        type_module (str): Module of the exception class
+        message (str): Exception message
+        exception_only (str): Last line(s) of the formatted exception
+        summary (TracebackSummary): Frames, thread and process details
+        fingerprint (str): See TicketsExceptHook.get_fingerprint
+        cause (ExceptionSnapshot): The exception's __cause__ or __context__
+        cause_message (str): Line printed between cause and exception
+    '''
+
+    __slots__ = (
+        'type',
+        'type_name',
+        'type_module',
+        'message',
+        'exception_only',
+        'summary',
+        'fingerprint',
+        'cause',
+        'cause_message',
+    )
+    direct_cause_message = (
+        'The above exception was the direct cause of the following '
+        'exception:'
+    )
+    context_message = (
+        'During handling of the above exception, another exception '
+        'occurred:'
+    )
+    max_message_size = 4096
+
+    def __init__(self, typ, value, summary):
+        self.type = typ
+        self.type_name = typ.__name__
+        self.type_module = typ.__module__
+        self.message = truncate_text(safe_str(value), self.max_message_size)
+        if issubclass(typ, SyntaxError):
+            exception_only = ''.join(
+                traceback.format_exception_only(typ, value)
+            )
+        else:
+            # Like traceback.format_exception_only without calling str on
+            # the exception again
+            exception_only = getattr(typ, '__qualname__', typ.__name__)
+            if self.type_module not in _builtin_modules:
+                exception_only = self.type_module + '.' + exception_only
+            if self.message:
+                exception_only += ': ' + self.message
+            exception_only += '\n'
+        self.exception_only = truncate_text(
+            exception_only,
+            self.max_message_size,
+        )
+        self.summary = summary
+        self.fingerprint = None
+        self.cause = None
+        self.cause_message = None
+
+    def __iter__(self):
+        '''Unpack like the (typ, value, tb) tuple hooks used to receive.
+
+        value is the exception message and tb the snapshot itself, which
+        TicketsExceptHook methods accept in place of a traceback.
+        '''
+
+        return iter((self.type, self.message, self))
+
+    def __getstate__(self):
+        # Exception classes may not be importable in other processes
+        return dict(
+            (slot, getattr(self, slot))
+            for slot in self.__slots__
+            if slot != 'type'
+        )
+
+    def __setstate__(self, state):
+        self.type = None
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    def format(self):
+        '''Format the exception like traceback.format_exception.'''
+
+        chain = []
+        snapshot = self
+        while snapshot:
+            chain.append(snapshot)
+            snapshot = snapshot.cause
+
+        lines = []
+        for snapshot in reversed(chain):
+            if snapshot.cause:
+                lines.append('\n%s\n\n' % snapshot.cause_message)
+            if snapshot.summary.frames:
+                lines.append('Traceback (most recent call last):\n')
+                lines.extend(format_frames(snapshot.summary.frames))
+            lines.append(snapshot.exception_only)
+        return ''.join(lines).rstrip('\n')
+
+
+class TracebackSummary(object):
+    '''Details of a traceback collected in a single pass.
+
+    Only tb_lineno, co_filename, co_name and the module __name__ of each
+    frame are read, source files are never loaded. The thread and process
+    are those that created the summary, so summarize tracebacks in the
+    thread they were raised in.
+
+    Attributes:
+        frames (list): (filename, lineno, function, module) per frame
+        module (str): Dotted module name of the last frame's file
+    '''
+
+    __slots__ = (
+        'frames',
+        'module',
+        'thread',
+        'thread_name',
+        'process',
+        'process_name',
+    )
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.module = None
         thread = threading.current_thread()
         process = multiprocessing.current_process()
+        self.thread = thread.ident
+        self.thread_name = thread.name
+        self.process = process.pid
+        self.process_name = process.name
+
+    @classmethod
+    def from_traceback(cls, tb):
+        frames = []
+        while tb:
+            frame = tb.tb_frame
+            frames.append((
+                frame.f_code.co_filename,
+                tb.tb_lineno,
+                frame.f_code.co_name,
+                frame.f_globals.get('__name__'),
+            ))
+            tb = tb.tb_next
+        return cls(frames)
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
+    @property
+    def filename(self):
+        return self.frames[-1][0]
+
+    @property
+    def lineno(self):
+        return self.frames[-1][1]
+
+    @property
+    def function(self):
+        return self.frames[-1][2]
+
+
+class TicketsRateLimiter(object):
+    '''Limits the rate at which exceptions become Tickets.
+
+    Uses a global token bucket and one token bucket per error fingerprint.
+    When the global rate is exceeded the circuit breaker opens and every
+    exception is suppressed until none were raised for cooldown seconds.
+    Suppressed exceptions are tracked so a summary can be reported once the
+    breaker closes.
+    '''
+
+    def __init__(self, rate, burst, error_rate, error_burst, cooldown):
+        self.error_rate = error_rate
+        self.error_burst = error_burst
+        self.cooldown = cooldown
+        self._bucket = TokenBucket(rate, burst)
+        self._error_buckets = LRUCache(1024)
+        self._lock = threading.Lock()
+        self._opened_at = None
+        self._last_suppressed = None
+        self._suppressed = {}
+
+    @property
+    def open(self):
+        return self._opened_at is not None
+
+    def allow(self, fingerprint, type_name):
+        '''Return True if an exception should be handled.'''
+
+        with self._lock:
+            now = time.time()
+            if not self.open:
+                if self._allow_error(fingerprint):
+                    if self._bucket.consume():
+                        return True
+                    self._opened_at = now
+                else:
+                    # Only this error is repeating, no need to open the breaker
+                    return False
+
+            self._suppress(fingerprint, type_name, now)
+            return False
+
+    def suppress(self, fingerprint, type_name):
+        '''Suppress an exception that was dropped before it reached allow.
+
+        Opens the circuit breaker, so the exception is reported in the
+        summary. fingerprint may be None when it's not known yet.
+        '''
+
+        with self._lock:
+            now = time.time()
+            if not self.open:
+                self._opened_at = now
+            self._suppress(fingerprint, type_name, now)
+
+    def _suppress(self, fingerprint, type_name, now):
+        self._last_suppressed = now
+        key = fingerprint, type_name
+        self._suppressed[key] = self._suppressed.get(key, 0) + 1
+
+    def _allow_error(self, fingerprint):
+        bucket = self._error_buckets.get(fingerprint)
+        if bucket is None:
+            bucket = TokenBucket(self.error_rate, self.error_burst)
+            self._error_buckets.set(fingerprint, bucket)
+        return bucket.consume()
+
+    def pop_summary(self):
+        '''Close the circuit breaker once its cooldown has passed.
+
+        Return:
+            None or (count, duration, suppressed) where suppressed maps
+            (fingerprint, type_name) to count.
+        '''
+
+        with self._lock:
+            if not self.open:
+                return
+            if time.time() - self._last_suppressed < self.cooldown:
+                return
+
+            suppressed = self._suppressed
+            count = sum(suppressed.values())
+            duration = self._last_suppressed - self._opened_at
+            self._opened_at = None
+            self._last_suppressed = None
+            self._suppressed = {}
+            return count, duration, suppressed
+
+
+class TokenBucket(object):
+    '''Allows rate actions per second with bursts of up to burst actions.'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.time()
+
+    def consume(self):
+        '''Take a token from the bucket, returns False if it's empty.'''
+
+        now = time.time()
+        elapsed = now - self._updated_at
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class TicketsSubmissionQueue(object):
+    '''Runs Ticket submission jobs in a background worker thread.
+
+    Jobs are stored in a bounded queue and executed in order by a single
+    daemon thread that is started on demand. tk-core caches Shotgun
+    connections per thread, so the worker talks to Shotgun through its own
+    connection. Periodic jobs, like replaying the spool, run in between.
+    '''
+
+    def __init__(self, app, maxsize=32):
+        self.app = app
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._periodic = []
+
+    def add_periodic(self, fn, interval, on_stop=False):
+        '''Call fn every interval seconds while the worker is running.
+
+        Arguments:
+            fn (callable): Job to run
+            interval (float): Seconds between calls
+            on_stop (bool): Also call fn once when the queue is stopped
+        '''
+
+        self._periodic.append({
+            'fn': fn,
+            'interval': interval,
+            'on_stop': on_stop,
+            'next_run': time.time() + interval,
+        })
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def in_worker_thread(self):
+        '''True when called from the worker thread.'''
+
+        return threading.current_thread() is self._thread
+
+    def start(self):
+        '''Start the worker thread.'''
+
+        with self._lock:
+            if self.running:
+                return
+
+            self._thread = threading.Thread(
+                target=self._run,
+                name='TicketsSubmissionQueue',
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, fn, *args, **kwargs):
+        '''Add a job to the queue without blocking.
+
+        Return:
+            False when the queue is full and the job was dropped.
+        '''
+
+        self.start()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=10):
+        '''Finish all pending jobs and stop the worker thread.
+
+        Arguments:
+            timeout (float): Max seconds to wait for pending jobs.
+        '''
+
+        if not self.running:
+            return
+
+        try:
+            self._queue.put((None, None, None), timeout=timeout)
+        except queue.Full:
+            self.app.logger.warning(
+                'Submission queue did not drain - pending Tickets were lost.'
+            )
+            return
+
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.app.logger.warning(
+                'Submission queue did not drain - pending Tickets were lost.'
+            )
+
+    def _run(self):
+        while True:
+            try:
+                fn, args, kwargs = self._queue.get(timeout=self._get_timeout())
+            except queue.Empty:
+                self._run_periodic()
+                continue
+
+            try:
+                if fn is None:
+                    self._run_periodic(stopping=True)
+                    return
+                fn(*args, **kwargs)
+            except Exception:
+                self.app.logger.exception('Failed to submit Ticket.')
+            finally:
+                self._queue.task_done()
+            self._run_periodic()
+
+    def _get_timeout(self):
+        '''Seconds until the next periodic job is due.'''
+
+        if not self._periodic:
+            return None
+        next_run = min(job['next_run'] for job in self._periodic)
+        return max(next_run - time.time(), 0)
+
+    def _run_periodic(self, stopping=False):
+        now = time.time()
+        for job in self._periodic:
+            if stopping:
+                if not job['on_stop']:
+                    continue
+            elif job['next_run'] > now:
+                continue
+
+            job['next_run'] = now + job['interval']
+            try:
+                job['fn']()
+            except Exception:
+                self.app.logger.exception('Periodic job %r failed.' % job)
+
+
+class TicketsCounter(object):
+    '''Accumulates occurrences of known errors by fingerprint.
+
+    Instead of updating a Ticket's sg_count each time its error occurs,
+    counts are collected in memory and flushed periodically with one find and
+    one batch request for all errors. Counts for errors whose Ticket does not
+    exist yet, like Tickets waiting in the spool, are kept for the next flush
+    and dropped when no Ticket turns up within unresolved_ttl seconds.
+    '''
+
+    unresolved_ttl = 900
+
+    def __init__(self, app):
+        self.app = app
+        self._counts = {}
+        self._unresolved = {}
+        self._lock = threading.Lock()
+
+    def add(self, fingerprint, count=1):
+        '''Count occurrences of an error.'''
+
+        with self._lock:
+            count += self._counts.get(fingerprint, 0)
+            self._counts[fingerprint] = count
+
+    def flush(self):
+        '''Add all accumulated counts to the sg_count of matching Tickets.'''
+
+        with self._lock:
+            counts, self._counts = self._counts, {}
+
+        # Take the counts of all processes on this host, so they reach
+        # Shotgun in a single request
+        try:
+            counts = self.app.fingerprints.collect_counts(counts)
+        except (OSError, sqlite3.Error):
+            self.app.logger.debug('Failed to collect counts.', exc_info=True)
+
+        if not counts:
+            return
+
+        try:
+            unresolved = self.app.io.increment_counts(counts)
+        except Exception:
+            # Keep all counts for the next flush
+            for fingerprint, count in counts.items():
+                self.add(fingerprint, count)
+            raise
+
+        # Keep counts of errors without a Ticket for a while, the Ticket may
+        # still be waiting in a dialog or the spool
+        now = time.time()
+        for fingerprint in counts:
+            if fingerprint not in unresolved:
+                self._unresolved.pop(fingerprint, None)
+        for fingerprint, count in unresolved.items():
+            since = self._unresolved.setdefault(fingerprint, now)
+            if now - since > self.unresolved_ttl:
+                self.app.logger.debug(
+                    'Dropping %s occurrences of %s - no Ticket found.'
+                    % (count, fingerprint)
+                )
+                del self._unresolved[fingerprint]
+                continue
+            self.add(fingerprint, count)
+
+
+class TicketsFingerprints(object):
+    '''Host-local table of error fingerprints shared by all processes.
+
+    Processes on the same machine, like the workers of a multiprocessing
+    pool or farm tasks, often raise the same error at once. The first
+    process to claim a fingerprint looks up or creates its Ticket, the
+    others only add to the fingerprint's pending count. Pending counts are
+    collected by the first process to flush its TicketsCounter.
+
+    Claims of errors without a Ticket expire after claim_timeout seconds and
+    all claims after claim_ttl seconds, so an error is looked up again when
+    its process exited before creating the Ticket. Claims store the pid of
+    their process, which can always claim the fingerprint again.
+    '''
+
+    claim_timeout = 600
+    claim_ttl = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        '''Open a connection, creating the database on first use.'''
+
+        with self._lock:
+            if not self._initialized:
+                root = os.path.dirname(self.path)
+                if not os.path.isdir(root):
+                    os.makedirs(root)
+
+                conn = sqlite3.connect(self.path, timeout=10)
+                try:
+                    with conn:
+                        conn.execute(
+                            'CREATE TABLE IF NOT EXISTS fingerprints ('
+                            '  fingerprint TEXT PRIMARY KEY,'
+                            '  claimed_at REAL NOT NULL,'
+                            '  ticket INTEGER,'
+                            '  pending_count INTEGER NOT NULL DEFAULT 0,'
+                            '  claimed_by INTEGER'
+                            ')'
+                        )
+                        columns = [
+                            row[1] for row in
+                            conn.execute('PRAGMA table_info(fingerprints)')
+                        ]
+                        if 'claimed_by' not in columns:
+                            conn.execute(
+                                'ALTER TABLE fingerprints '
+                                'ADD COLUMN claimed_by INTEGER'
+                            )
+                finally:
+                    conn.close()
+                self._initialized = True
+
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''Connect and lock the database for writing until committed.'''
+
+        conn = self._open()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def claim(self, fingerprint):
+        '''Claim a fingerprint for this process.
+
+        Return:
+            True if this process should look up or create the Ticket of the
+            error. False when another process already does, in that case
+            the error is added to the fingerprint's pending count.
+        '''
+
+        now = time.time()
+        pid = os.getpid()
+        with self._transaction() as conn:
+            claimed = conn.execute(
+                'INSERT OR IGNORE INTO fingerprints '
+                '(fingerprint, claimed_at, claimed_by) '
+                'VALUES (?, ?, ?)',
+                (fingerprint, now, pid),
+            ).rowcount
+            if not claimed:
+                # Take over expired claims and claims of this process
+                claimed = conn.execute(
+                    'UPDATE fingerprints '
+                    'SET claimed_at = ?, claimed_by = ?, ticket = NULL '
+                    'WHERE fingerprint = ? AND (claimed_by = ? '
+                    'OR claimed_at < ? '
+                    'OR (ticket IS NULL AND claimed_at < ?))',
+                    (
+                        now,
+                        pid,
+                        fingerprint,
+                        pid,
+                        now - self.claim_ttl,
+                        now - self.claim_timeout,
+                    ),
+                ).rowcount
+            if not claimed:
+                conn.execute(
+                    'UPDATE fingerprints '
+                    'SET pending_count = pending_count + 1 '
+                    'WHERE fingerprint = ?',
+                    (fingerprint,),
+                )
+        return bool(claimed)
+
+    def release(self, fingerprint):
+        '''Release the claim of a fingerprint that has no Ticket.'''
+
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE fingerprints SET claimed_at = 0 '
+                'WHERE fingerprint = ? AND ticket IS NULL',
+                (fingerprint,),
+            )
+
+    def set_ticket(self, fingerprint, ticket_id):
+        '''Store the Ticket id of a claimed fingerprint.'''
+
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE fingerprints SET ticket = ?, claimed_at = ? '
+                'WHERE fingerprint = ?',
+                (ticket_id, time.time(), fingerprint),
+            )
+
+    def collect_counts(self, counts):
+        '''Add counts to the pending counts, then take all pending counts.
+
+        Arguments:
+            counts (dict): Mapping of fingerprint to count
+
+        Return:
+            Dict of the pending counts of all processes on this host.
+        '''
+
+        now = time.time()
+        with self._transaction() as conn:
+            # Unknown fingerprints are added unclaimed
+            conn.executemany(
+                'INSERT OR IGNORE INTO fingerprints (fingerprint, claimed_at) '
+                'VALUES (?, 0)',
+                [(fingerprint,) for fingerprint in counts],
+            )
+            conn.executemany(
+                'UPDATE fingerprints SET pending_count = pending_count + ? '
+                'WHERE fingerprint = ?',
+                [(count, fp) for fp, count in counts.items()],
+            )
+            rows = conn.execute(
+                'SELECT fingerprint, pending_count FROM fingerprints '
+                'WHERE pending_count > 0'
+            ).fetchall()
+            conn.execute(
+                'UPDATE fingerprints SET pending_count = 0 '
+                'WHERE pending_count > 0'
+            )
+            conn.execute(
+                'DELETE FROM fingerprints WHERE claimed_at < ?',
+                (now - self.claim_ttl,),
+            )
+        return dict(rows)
+
+
+class TicketsSpool(object):
+    '''Durable on-disk store for Tickets waiting to be submitted.
+
+    Ticket data is stored in a SQLite database and attachments are copied
+    next to it, so Tickets survive Shotgun outages and host crashes. The
+    spool must be on a local drive, SQLite locking isn't reliable on
+    network drives. Entries
+    are claimed while being submitted so that multiple threads or processes
+    sharing a spool never submit the same Ticket twice.
+
+    Entries are dicts with the keys: id, fields, attachments, ticket and
+    finished - True once after_create_ticket was called for the entry.
+    '''
+
+    claim_timeout = 300
+    max_retry_delay = 3600
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, 'spool.db')
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def _open(self, **kwargs):
+        '''Open a connection, creating the database on first use.'''
+
+        with self._lock:
+            if not self._initialized:
+                if not os.path.isdir(self.root):
+                    os.makedirs(self.root)
+
+                conn = sqlite3.connect(self.path, timeout=30)
+                try:
+                    with conn:
+                        conn.execute(
+                            'CREATE TABLE IF NOT EXISTS tickets ('
+                            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                            '  fields TEXT NOT NULL,'
+                            '  attachments TEXT NOT NULL,'
+                            '  ticket TEXT,'
+                            '  attempts INTEGER NOT NULL DEFAULT 0,'
+                            '  retry_at REAL NOT NULL DEFAULT 0,'
+                            '  claimed_at REAL,'
+                            '  finished INTEGER NOT NULL DEFAULT 0'
+                            ')'
+                        )
+                        columns = [
+                            row[1] for row in
+                            conn.execute('PRAGMA table_info(tickets)')
+                        ]
+                        if 'finished' not in columns:
+                            conn.execute(
+                                'ALTER TABLE tickets ADD COLUMN '
+                                'finished INTEGER NOT NULL DEFAULT 0'
+                            )
+                finally:
+                    conn.close()
+                self._initialized = True
+
+        return sqlite3.connect(self.path, timeout=30, **kwargs)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = self._open()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _to_entry(self, row):
         return {
-            'filename': frame_info.filename.replace('\\', '/'),
-            'module': module,
-            'thread': thread.ident,
-            'threadName': thread.name,
-            'process': process.pid,
-            'processName': process.name,
-            'lineno': frame_info.lineno,
-            'funcName': frame_info.function,
-            'culprit': module + '.' + frame_info.function,
+            'id': row[0],
+            'fields': json.loads(row[1]),
+            'attachments': json.loads(row[2]),
+            'ticket': json.loads(row[3]) if row[3] else None,
+            'finished': bool(row[4]),
         }
 
+    def count(self):
+        '''Number of Tickets in the spool.'''
+
+        if not self.exists:
+            return 0
+
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM tickets').fetchone()[0]
+
+    def add(self, fields, attachments):
+        '''Add a Ticket to the spool.
+
+        Attachments can be file paths, which are copied into the spool, or
+        (filename, data) tuples, which are written straight to the spool.
+        The new entry is returned already claimed by the caller.
+        '''
+
+        with self._connect() as conn:
+            entry_id = conn.execute(
+                'INSERT INTO tickets (fields, attachments, claimed_at) '
+                'VALUES (?, ?, ?)',
+                (json.dumps(fields, default=str), '[]', time.time()),
+            ).lastrowid
+
+        # Copy attachments so temp files can be removed by the caller
+        spooled_attachments = []
+        try:
+            if attachments:
+                entry_dir = os.path.join(self.root, str(entry_id))
+                os.makedirs(entry_dir)
+                for i, attachment in enumerate(attachments):
+                    if isinstance(attachment, tuple):
+                        filename, data = attachment
+                    else:
+                        filename, data = os.path.basename(attachment), None
+
+                    dst = os.path.join(
+                        entry_dir,
+                        '{:0>2d}_{}'.format(i, filename),
+                    )
+                    if data is None:
+                        shutil.copy2(attachment, dst)
+                    else:
+                        with open(dst, 'wb') as f:
+                            f.write(data)
+                    spooled_attachments.append(dst)
+                self.set_attachments(entry_id, spooled_attachments)
+        except Exception:
+            # Don't leave an entry without its attachments behind
+            self.remove(entry_id)
+            raise
+
+        return {
+            'id': entry_id,
+            'fields': fields,
+            'attachments': spooled_attachments,
+            'ticket': None,
+            'finished': False,
+        }
+
+    def claim(self, limit):
+        '''Claim up to limit entries that are ready to be submitted.'''
+
+        if not self.exists:
+            return []
+
+        now = time.time()
+        conn = self._open(isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT id, fields, attachments, ticket, finished '
+                'FROM tickets '
+                'WHERE retry_at <= ? '
+                'AND (claimed_at IS NULL OR claimed_at < ?) '
+                'ORDER BY id LIMIT ?',
+                (now, now - self.claim_timeout, limit),
+            ).fetchall()
+            conn.executemany(
+                'UPDATE tickets SET claimed_at = ? WHERE id = ?',
+                [(now, row[0]) for row in rows],
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return [self._to_entry(row) for row in rows]
+
+    def release(self, entry_id):
+        '''Release a claimed entry after a failed submission.
+
+        The entry will be retried later with an exponential backoff.
+        '''
+
+        with self._connect() as conn:
+            attempts = conn.execute(
+                'SELECT attempts FROM tickets WHERE id = ?',
+                (entry_id,),
+            ).fetchone()
+            if not attempts:
+                return
+            attempts = attempts[0] + 1
+            delay = min(30 * 2 ** attempts, self.max_retry_delay)
+            conn.execute(
+                'UPDATE tickets '
+                'SET claimed_at = NULL, attempts = ?, retry_at = ? '
+                'WHERE id = ?',
+                (attempts, time.time() + delay, entry_id),
+            )
+
+    def set_ticket(self, entry_id, ticket):
+        '''Store the Ticket created for an entry.'''
+
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE tickets SET ticket = ? WHERE id = ?',
+                (json.dumps(ticket, default=str), entry_id),
+            )
+
+    def set_finished(self, entry_id):
+        '''Mark an entry whose after_create_ticket hook was called.'''
+
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE tickets SET finished = 1 WHERE id = ?',
+                (entry_id,),
+            )
+
+    def set_attachments(self, entry_id, attachments):
+        '''Store the attachments that still need to be uploaded.'''
+
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE tickets SET attachments = ? WHERE id = ?',
+                (json.dumps(attachments), entry_id),
+            )
+
+    def remove(self, entry_id):
+        '''Remove an entry and its attachments from the spool.'''
+
+        with self._connect() as conn:
+            conn.execute('DELETE FROM tickets WHERE id = ?', (entry_id,))
+
+        entry_dir = os.path.join(self.root, str(entry_id))
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
 
 class TicketsIO(object):
     '''Responsible for all interactions with Shotgun Database.'''
 
+    ticket_fields = [
+        'created_by',
+        'created_at',
+        'project',
+        'title',
+        'description',
+        'addressings_to',
+        'sg_context',
+        'sg_error',
+        'sg_fingerprint',
+        'sg_count',
+        'sg_type',
+        'sg_priority',
+        'sg_status_list',
+    ]
+
     def __init__(self, app):
         self.app = app
-        self.shotgun = app.shotgun
+        self.schema_cache_path = os.path.join(
+            app.cache_location,
+            'schema_cache.json',
+        )
+        self._schema_cache = {}
+        self._schema_lock = threading.Lock()
+
+        # Maps hashes of recently uploaded files to their Attachment ids
+        self._uploaded_attachments = LRUCache(
+            256,
+            app.get_setting('attachment_dedupe_ttl', 0),
+        )
+
+    @property
+    def shotgun(self):
+        # tk-core returns a connection per thread, so TicketsIO can be used
+        # from the submission_queue worker.
+        return self.app.shotgun
 
     def get_priority_values(self):
-        schema = self.shotgun.schema_field_read('Ticket', 'sg_priority')
-        props = schema['sg_priority']['properties']
-        return props['valid_values']['value']
+        return self.get_valid_values('sg_priority')
 
     def get_type_values(self):
-        schema = self.shotgun.schema_field_read('Ticket', 'sg_ticket_type')
-        props = schema['sg_ticket_type']['properties']
-        return props['valid_values']['value']
+        return self.get_valid_values('sg_ticket_type')
+
+    def get_valid_values(self, field):
+        '''Get the valid values of a Ticket list field.
+
+        Values are cached in memory and on disk for schema_cache_ttl seconds
+        so the schema is only read from Shotgun once in a while.
+        '''
+
+        ttl = self.app.get_setting('schema_cache_ttl', 86400)
+        with self._schema_lock:
+            if not self._schema_cache:
+                self._schema_cache = self._read_schema_cache()
+
+            cached = self._schema_cache.get(field)
+            if cached and time.time() - cached['cached_at'] < ttl:
+                return list(cached['values'])
+
+        schema = self.shotgun.schema_field_read('Ticket', field)
+        props = schema[field]['properties']
+        values = props['valid_values']['value']
+
+        with self._schema_lock:
+            self._schema_cache[field] = {
+                'values': values,
+                'cached_at': time.time(),
+            }
+            self._write_schema_cache(self._schema_cache)
+        return list(values)
+
+    def invalidate_schema_cache(self):
+        '''Clear cached schema values from memory and disk.'''
+
+        with self._schema_lock:
+            self._schema_cache = {}
+            if os.path.isfile(self.schema_cache_path):
+                os.remove(self.schema_cache_path)
+
+    def _read_schema_cache(self):
+        try:
+            with open(self.schema_cache_path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_schema_cache(self, cache):
+        try:
+            with open(self.schema_cache_path, 'w') as f:
+                json.dump(cache, f)
+        except (IOError, OSError):
+            self.app.logger.debug(
+                'Failed to write schema cache.',
+                exc_info=True,
+            )
+
+    def find_assignee(self, name):
+        '''Find a HumanUser or Group by name.'''
+
+        assignee = self.shotgun.find_one(
+            'HumanUser',
+            [['name', 'is', name]],
+            ['id', 'name'],
+        )
+        if assignee:
+            assignee['type'] = 'HumanUser'
+            return assignee
+
+        assignee = self.shotgun.find_one(
+            'Group',
+            [['code', 'is', name]],
+            ['id', 'code'],
+        )
+        if assignee:
+            assignee['type'] = 'Group'
+            return assignee
+
+    def find_matching_error(self, fingerprint):
+        '''Find a Ticket by traceback fingerprint.'''
 
-    def find_matching_error(self, error):
         return self.shotgun.find_one(
             'Ticket',
-            [['sg_error', 'is', error]],
+            [['sg_fingerprint', 'is', fingerprint]],
             ['id', 'sg_count'],
         )
 
+    def find_matching_errors(self, fingerprints):
+        '''Find the Tickets of multiple traceback fingerprints.
+
+        Tickets are ordered by id, so the oldest Ticket of a fingerprint
+        comes first.
+        '''
+
+        return self.shotgun.find(
+            'Ticket',
+            [['sg_fingerprint', 'in', list(fingerprints)]],
+            ['id', 'sg_count', 'sg_fingerprint'],
+            order=[{'field_name': 'id', 'direction': 'asc'}],
+        )
+
+    def increment_counts(self, counts):
+        '''Add counts to the sg_count field of Tickets.
+
+        Shotgun has no atomic increment, so sg_count is read and written
+        back. Increments flushed by different hosts at the same moment can
+        still overwrite each other.
+
+        Arguments:
+            counts (dict): Mapping of fingerprint to count
+
+        Return:
+            Dict of counts that did not match any Ticket.
+        '''
+
+        tickets = self.shotgun.find(
+            'Ticket',
+            [['sg_fingerprint', 'in', list(counts)]],
+            ['id', 'sg_count', 'sg_fingerprint'],
+            order=[{'field_name': 'id', 'direction': 'asc'}],
+        )
+
+        unresolved = dict(counts)
+        requests = []
+        for ticket in tickets:
+            count = unresolved.pop(ticket['sg_fingerprint'], None)
+            if count is None:
+                # Already updated an older Ticket with the same fingerprint
+                continue
+            requests.append({
+                'request_type': 'update',
+                'entity_type': 'Ticket',
+                'entity_id': ticket['id'],
+                'data': {'sg_count': (ticket['sg_count'] or 0) + count},
+            })
+
+        if requests:
+            self.app.logger.debug(
+                'Updating sg_count of %s Tickets' % len(requests)
+            )
+            self.shotgun.batch(requests)
+
+        return unresolved
+
     def send_notification(self, ticket):
         '''Create a Note ensuring that users receive a notification in their
         Shotgun Inbox.'''
 
-        assignees = ticket['addressings_to']
-        created_by = ticket['created_by']
+        return self.shotgun.create(
+            'Note',
+            data=self._get_notification_data(ticket),
+        )
+
+    def send_notifications(self, tickets):
+        '''Create Notes for multiple Tickets in a single request.'''
+
+        return self.shotgun.batch([
+            {
+                'request_type': 'create',
+                'entity_type': 'Note',
+                'data': self._get_notification_data(ticket),
+            }
+            for ticket in tickets
+        ])
+
+    def _get_notification_data(self, ticket):
         subject = "%s's new Ticket #%s." % (
             ticket['created_by']['name'],
             ticket['id']
         )
-        return self.shotgun.create(
-            'Note',
-            data={
-                'addressings_to': ticket['addressings_to'],
-                'user': ticket['created_by'],
-                'subject': subject,
-                'content': '%s' % self.app.get_ticket_url(ticket['id']),
-                'project': ticket['project'],
-                'note_links': [{'type': 'Ticket', 'id': ticket['id']}],
-                'sg_note_type': 'Internal',
-            },
-        )
+        return {
+            'addressings_to': ticket['addressings_to'],
+            'user': ticket['created_by'],
+            'subject': subject,
+            'content': '%s' % self.app.get_ticket_url(ticket['id']),
+            'project': ticket['project'],
+            'note_links': [{'type': 'Ticket', 'id': ticket['id']}],
+            'sg_note_type': 'Internal',
+        }
 
     def create(self, data):
         '''Create a Ticket.'''
@@ -543,21 +2739,23 @@ class TicketsIO(object):
         return self.shotgun.create(
             'Ticket',
             data=data,
-            return_fields=[
-                'created_by',
-                'created_at',
-                'project',
-                'title',
-                'description',
-                'addressings_to',
-                'sg_context',
-                'sg_error',
-                'sg_type',
-                'sg_priority',
-                'sg_status_list',
-            ]
+            return_fields=self.ticket_fields,
         )
 
+    def create_batch(self, datas):
+        '''Create multiple Tickets in a single request.'''
+
+        self.app.logger.debug('Creating %s new Tickets' % len(datas))
+        return self.shotgun.batch([
+            {
+                'request_type': 'create',
+                'entity_type': 'Ticket',
+                'data': data,
+                'return_fields': self.ticket_fields,
+            }
+            for data in datas
+        ])
+
     def update(self, ticket_id, data):
         '''Update a Ticket.'''
 
@@ -566,19 +2764,189 @@ class TicketsIO(object):
         )
         return self.shotgun.update('Ticket', ticket_id, data)
 
-    def upload_attachments(self, ticket_id, attachments):
-        '''Upload Ticket attachments.'''
+    def upload_attachments(self, ticket_id, attachments, progress=None):
+        '''Upload Ticket attachments.
+
+        Attachments are uploaded in parallel by upload_workers threads, each
+        with its own Shotgun connection. Failed uploads are retried up to
+        upload_retries times. Files with identical contents are only
+        uploaded once, and when attachment_dedupe_ttl is set, files uploaded
+        recently for another Ticket are linked instead of uploaded again.
+
+        Arguments:
+            ticket_id (int): Ticket to attach files to
+            attachments (list): Paths to files
+            progress (callable): Called with (done, total) before the first
+                and after each upload, total excludes duplicates. May be
+                called from a worker thread.
+
+        Return:
+            List of attachments that failed to upload.
+        '''
 
-        for i, attachment in enumerate(attachments):
+        # Skip attachments with identical contents
+        unique = OrderedDict()
+        for attachment in attachments:
+            unique.setdefault(get_file_hash(attachment), attachment)
+        if len(unique) < len(attachments):
             self.app.logger.debug(
-                'Uploading attachment (%s of %s)' % (i + 1, len(attachments))
+                'Skipping %s duplicate attachments.'
+                % (len(attachments) - len(unique))
             )
-            self.shotgun.upload(
-                entity_type='Ticket',
-                entity_id=ticket_id,
-                path=attachment,
-                field_name='attachments',
+
+        total = len(unique)
+        if progress:
+            progress(0, total)
+        workers = min(self.app.get_setting('upload_workers', 4), total)
+        retries = self.app.get_setting('upload_retries', 2)
+        pending = queue.Queue()
+        for item in unique.items():
+            pending.put(item)
+
+        lock = threading.Lock()
+        done = []
+        failed = []
+
+        def upload_pending():
+            while True:
+                try:
+                    digest, attachment = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                uploaded = self._upload_attachment(
+                    ticket_id,
+                    attachment,
+                    digest,
+                    retries,
+                )
+                with lock:
+                    done.append(attachment)
+                    if not uploaded:
+                        failed.append(attachment)
+                    if progress:
+                        progress(len(done), total)
+
+        if workers <= 1:
+            upload_pending()
+        else:
+            threads = []
+            for i in range(workers):
+                thread = threading.Thread(
+                    target=upload_pending,
+                    name='TicketsUpload%s' % i,
+                )
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        # Keep the original order of attachments
+        return [a for a in attachments if a in failed]
+
+    def _upload_attachment(self, ticket_id, attachment, digest, retries):
+        '''Upload a single attachment, returns True on success.'''
+
+        attachment_id = self._uploaded_attachments.get(digest)
+        if attachment_id:
+            try:
+                self.app.logger.debug(
+                    'Linking Attachment #%s to Ticket #%s'
+                    % (attachment_id, ticket_id)
+                )
+                self.shotgun.update(
+                    'Ticket',
+                    ticket_id,
+                    {'attachments': [
+                        {'type': 'Attachment', 'id': attachment_id},
+                    ]},
+                    multi_entity_update_modes={'attachments': 'add'},
+                )
+                return True
+            except Exception:
+                self.app.logger.debug(
+                    'Failed to link Attachment - uploading it again.',
+                    exc_info=True,
+                )
+                self._uploaded_attachments.pop(digest)
+
+        for attempt in range(retries + 1):
+            self.app.logger.debug(
+                'Uploading attachment %s (attempt %s)' % (attachment, attempt)
             )
+            try:
+                attachment_id = self.shotgun.upload(
+                    entity_type='Ticket',
+                    entity_id=ticket_id,
+                    path=attachment,
+                    field_name='attachments',
+                )
+                if self._uploaded_attachments.ttl:
+                    self._uploaded_attachments.set(digest, attachment_id)
+                return True
+            except Exception:
+                self.app.logger.warning(
+                    'Failed to upload attachment %s' % attachment,
+                    exc_info=True,
+                )
+                if attempt < retries:
+                    time.sleep(attempt + 1)
+        return False
+
+
+class LRUCache(object):
+    '''Thread-safe mapping that holds a limited number of items.
+
+    The least recently used items are evicted when maxsize is reached and
+    items expire ttl seconds after they were set, or after the ttl passed
+    to set.
+    '''
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._items.pop(key)
+            except KeyError:
+                return default
+
+            if expires_at is not None and expires_at < time.time():
+                return default
+
+            self._items[key] = value, expires_at
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            expires_at = time.time() + ttl if ttl else None
+            self._items[key] = value, expires_at
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_missing = object()
 
 
 def is_tickets_excepthook(obj):
@@ -591,7 +2959,179 @@ def is_tickets_excepthook(obj):
     return getattr(obj, '_is_tickets_excepthook', False)
 
 
+def is_main_thread():
+    '''Check if called from the main thread.'''
+
+    main_thread = getattr(threading, 'main_thread', None)
+    if main_thread:
+        return threading.current_thread() is main_thread()
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def accepts_argument(func, name):
+    '''Check if a function or method accepts a keyword argument.'''
+
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except AttributeError:
+        # Python 2
+        spec = inspect.getargspec(func)
+        return name in spec.args or spec.keywords is not None
+    return any(
+        parameter.name == name or parameter.kind == parameter.VAR_KEYWORD
+        for parameter in parameters
+    )
+
+
+def get_host_cache_dir():
+    '''Get a directory for data shared by the processes on this machine.
+
+    The app's cache_location may be on a network drive shared by many
+    machines, the system temp directory is local.
+    '''
+
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = 'default'
+    return os.path.join(tempfile.gettempdir(), 'tk-multi-tickets-' + user)
+
+
+def get_file_hash(path):
+    '''Get the sha1 hash of a file's contents.'''
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def code_block(text):
     '''Wraps text in triple backticks making it a markdown codeblock.'''
 
-    return '```\n{}\n```'.format(text)
\ No newline at end of file
+    return '```\n{}\n```'.format(text)
+
+
+def get_module_path_key(path):
+    '''Normalize the path of a python module for use as a cache key.
+
+    Extensions are removed so that .py and .pyc files share a key.
+    '''
+
+    path = os.path.normcase(os.path.abspath(path))
+    return os.path.splitext(path)[0]
+
+
+def get_type_name(typ):
+    '''Get the dotted name of an exception type.'''
+
+    if typ.__module__ in ('builtins', 'exceptions', '__builtin__'):
+        return typ.__name__
+    return typ.__module__ + '.' + typ.__name__
+
+
+def safe_str(value):
+    '''str that never raises.'''
+
+    try:
+        return str(value)
+    except Exception:
+        return '<unprintable %s object>' % type(value).__name__
+
+
+def format_frames(frames):
+    '''Format TracebackSummary frames like traceback.format_list.
+
+    Like python 3's traceback module, a frame repeated more than three times
+    in a row - by a recursive call - is shown three times followed by a line
+    counting the repeats.
+    '''
+
+    lines = []
+    last = None
+    repeats = 0
+    for filename, lineno, function, _ in frames:
+        frame = (filename, lineno, function)
+        if frame == last:
+            repeats += 1
+            if repeats >= 3:
+                continue
+        else:
+            if repeats >= 3:
+                lines.append(format_repeated_frame(repeats - 2))
+            last = frame
+            repeats = 0
+
+        line = '  File "%s", line %s, in %s\n' % (filename, lineno, function)
+        linecache.checkcache(filename)
+        source = linecache.getline(filename, lineno).strip()
+        if source:
+            line += '    %s\n' % source
+        lines.append(line)
+    if repeats >= 3:
+        lines.append(format_repeated_frame(repeats - 2))
+    return lines
+
+
+def format_repeated_frame(count):
+    return '  [Previous frame repeated %d more time%s]\n' % (
+        count,
+        's' if count > 1 else '',
+    )
+
+
+_builtin_modules = ('__main__', 'builtins', 'exceptions', '__builtin__')
+
+
+def truncate_text(text, max_size):
+    '''Cut the middle out of text longer than max_size characters.
+
+    The start and the end of the text - for tracebacks the outermost frames
+    and the error itself - are kept. Text is returned as is when max_size
+    is 0.
+    '''
+
+    if not max_size or len(text) <= max_size:
+        return text
+
+    marker = '\n[... %d characters truncated ...]\n'
+    keep = max(max_size - len(marker % len(text)), 0)
+    head = keep // 4
+    tail = keep - head
+    return (
+        text[:head]
+        + marker % (len(text) - keep)
+        + text[len(text) - tail:]
+    )
+
+
+def gzip_text(text):
+    '''Compress text to gzip data.'''
+
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+        f.write(text)
+    return buffer.getvalue()
+
+
+_memory_address = re.compile(r'0x[0-9a-fA-F]+')
+_tmp_name = re.compile(r'tmp[a-zA-Z0-9_]{6,}')
+_import_uid = re.compile(r'\b(tkimp)?[0-9a-f]{32}\b')
+_volatile_module_name = re.compile(
+    r'^(__main__|__mp_main__|(tkimp)?[0-9a-f]{32})(\.|$)'
+)
+
+
+def normalize_fingerprint_part(text):
+    '''Strip volatile data like memory addresses and temp names from text.'''
+
+    tmp_dir = tempfile.gettempdir().replace('\\', '/')
+    text = text.replace('\\', '/').replace(tmp_dir, '<tmp>')
+    text = _memory_address.sub('0x?', text)
+    text = _tmp_name.sub('tmp?', text)
+    text = _import_uid.sub('tkimp?', text)
+    return text
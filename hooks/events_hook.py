@@ -1,5 +1,4 @@
 import sgtk
-import traceback
 
 
 HookBaseClass = sgtk.get_hook_baseclass()
@@ -8,16 +7,20 @@ HookBaseClass = sgtk.get_hook_baseclass()
 class TicketsEventsHook(HookBaseClass):
     '''One hook to handle all tk-multi-tickets events.'''
 
-    def exception_filter(self, typ, value, tb):
+    def exception_filter(self, exc_info):
         '''Called when an unhandled exception occurs.
 
         This method filters unhandled exceptions returning True when an
         exception is deemed important enough to create a Ticket.
 
+        The exception_filter(self, typ, value, tb) signature is deprecated.
+        Overrides using it still work. They are called with the exception
+        and its traceback, in the thread that raised it.
+
         Arguments:
-            type: Exception class
-            value: Exception instance
-            traceback: Exception traceback
+            exc_info (ExceptionSnapshot): Unhandled exception info. The
+                traceback itself is not available, it was released as soon
+                as the exception was handled.
 
         Return:
             True if a Ticket should be created for the Exception
@@ -25,11 +28,11 @@ class TicketsEventsHook(HookBaseClass):
 
         # Always log unhandled exceptions....
         self.parent.engine.log_error('Unhandled Exception!')
-        exc_message = ''.join(traceback.format_exception(typ, value, tb))
+        exc_message = self.parent.excepthook.format_exception(exc_info)
         self.parent.engine.log_error(exc_message)
 
         return self.parent.excepthook.is_important_traceback(
-            tb=tb,
+            tb=exc_info,
             includes=self.parent.excepthook.includes,
             excludes=self.parent.excepthook.excludes,
         )
@@ -38,13 +41,17 @@ class TicketsEventsHook(HookBaseClass):
         '''Called before a Ticket is created.
 
         You can use this method to augment a Ticket's fields, context or
-        customize it's error message.
+        customize it's error message. Called in the main thread, except for
+        Tickets created in the background, see after_create_ticket.
 
         Arguments:
             fields (dict): Ticket field data
             context (dict): Ticket context dict
             error (None or str): Formated unhandled exception traceback
-            exc_info (None or (typ, value, tb)): Unhandled exception info
+            exc_info (None or ExceptionSnapshot): Unhandled exception info.
+                Can be unpacked like the (typ, value, tb) tuple passed by
+                earlier versions, value is then the message and tb the
+                snapshot.
 
         Return:
             Modified fields, context and error message.
@@ -56,6 +63,11 @@ class TicketsEventsHook(HookBaseClass):
         '''Called after a Ticket is created.
 
         Use this method if you'd like to perform a task with the new Ticket.
+        Called in the main thread by create_ticket once the Ticket and its
+        attachments exist. Tickets created in the background call it from a
+        background thread. Those are Tickets of unhandled exceptions that
+        don't show the Tickets dialog, and Tickets submitted later from the
+        spool because Shotgun could not be reached.
 
         Arguments:
             ticket (dict): Newly created Ticket entity including all fields.
@@ -1 +1 @@
-from . import tickets_submitter, dialogs
+from . import tickets_submitter, submission, dialogs
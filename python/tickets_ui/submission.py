@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+# Standard library imports
+import textwrap
+import threading
+import traceback
+import webbrowser
+
+# Shotgun imports
+import sgtk
+from sgtk.platform.qt import QtCore, QtGui
+
+# Local imports
+from .dialogs import ErrorDialog
+from . import res
+
+
+app = sgtk.platform.current_bundle()
+
+# Submissions are kept alive here until they finish
+_submissions = set()
+
+
+def submit(fields, context, attachments, exc_info=None):
+    '''Submit a Ticket in the background.
+
+    Arguments:
+        fields (dict): Ticket data
+        context (Context): Ticket Context
+        attachments (list): Attachments to add to the Ticket
+        exc_info (ExceptionSnapshot): Optional Exception info
+
+    Return:
+        Submission
+    '''
+
+    submission = Submission(fields, context, attachments, exc_info)
+    submission.start()
+    return submission
+
+
+class Submission(QtCore.QObject):
+    '''Submits a Ticket in a background thread.
+
+    The submission runs in stages - encode, create, upload and notify - and
+    reports its progress in a non-modal SubmissionProgress indicator. The
+    "Ticket Submitted" message is shown when it's done.
+    '''
+
+    stage_messages = {
+        'encode': 'Encoding attachments',
+        'create': 'Creating Ticket',
+        'upload': 'Uploading attachments',
+        'notify': 'Sending notification',
+    }
+    progress = QtCore.Signal(str)
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+
+    def __init__(self, fields, context, attachments, exc_info=None):
+        super(Submission, self).__init__()
+
+        self.fields = fields
+        self.context = context
+        self.attachments = attachments
+        self.exc_info = exc_info
+
+        self.indicator = SubmissionProgress()
+        self.progress.connect(self.indicator.set_message)
+        self.finished.connect(self._on_finished)
+        self.failed.connect(self._on_failed)
+
+    def start(self):
+        '''Start submitting the Ticket.'''
+
+        _submissions.add(self)
+        self.indicator.show()
+        thread = threading.Thread(target=self._run, name='TicketsSubmission')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        try:
+            # Attachments are passed to create_ticket as data, so they're
+            # written to disk only once - in the Tickets spool. Identical
+            # screen captures are skipped.
+            attachments = []
+            hashes = set()
+            for i, attachment in enumerate(self.attachments):
+                self._report('encode', i + 1, len(self.attachments))
+                if attachment.hash in hashes:
+                    continue
+                hashes.add(attachment.hash)
+                filename = 'image{:0>2d}.{}'.format(i, attachment.extension)
+                attachments.append((filename, attachment.data))
+
+            ticket = app.create_ticket(
+                fields=self.fields,
+                context=self.context,
+                attachments=attachments,
+                exc_info=self.exc_info,
+                progress=self._report,
+            )
+        except Exception:
+            app.logger.exception('Error')
+            self.failed.emit(traceback.format_exc())
+            return
+        self.finished.emit(ticket)
+
+    def _report(self, stage, done=None, total=None):
+        '''Called from the submission thread to report progress.'''
+
+        message = self.stage_messages[stage]
+        if total:
+            message += ' (%s of %s)' % (done, total)
+        self.progress.emit(message + '...')
+
+    def _on_finished(self, ticket):
+        self.indicator.close()
+        _submissions.discard(self)
+        show_submitted(ticket)
+
+    def _on_failed(self, message):
+        self.indicator.close()
+        _submissions.discard(self)
+        error_message = ErrorDialog(
+            label='Failed to submit Ticket.',
+            message=message,
+        )
+        error_message.exec_()
+
+
+class SubmissionProgress(QtGui.QWidget):
+    '''Small non-modal indicator shown in the corner of the screen.'''
+
+    style = textwrap.dedent('''
+        QWidget {
+            background: #2D9CDB;
+        }
+        QLabel {
+            color: #EEE;
+        }
+    ''')
+
+    def __init__(self, parent=None):
+        super(SubmissionProgress, self).__init__(parent=parent)
+
+        self.label = QtGui.QLabel(
+            'Submitting Ticket...',
+            alignment=QtCore.Qt.AlignCenter,
+        )
+        layout = QtGui.QVBoxLayout()
+        layout.addWidget(self.label)
+        layout.setContentsMargins(12, 6, 12, 6)
+        self.setLayout(layout)
+        self.setStyleSheet(self.style)
+        self.setWindowFlags(
+            QtCore.Qt.Tool
+            | QtCore.Qt.FramelessWindowHint
+            | QtCore.Qt.WindowStaysOnTopHint
+        )
+        self.setAttribute(QtCore.Qt.WA_ShowWithoutActivating)
+        self.setFixedSize(300, 30)
+
+    def set_message(self, message):
+        self.label.setText(message)
+
+    def showEvent(self, event):
+        # Move to the bottom right corner of the screen
+        desktop = QtGui.QApplication.instance().desktop()
+        rect = desktop.availableGeometry()
+        self.move(
+            rect.right() - self.width() - 20,
+            rect.bottom() - self.height() - 20,
+        )
+        super(SubmissionProgress, self).showEvent(event)
+
+
+def show_submitted(ticket):
+    '''Show the "Ticket Submitted" message.'''
+
+    msg = QtGui.QMessageBox()
+    msg.setWindowIcon(QtGui.QIcon(res.get_path('icon_256.png')))
+    msg.setWindowTitle('Ticket Submitted')
+    if not ticket:
+        # Shotgun is unreachable, the ticket was spooled
+        msg.setText(
+            'Shotgun could not be reached. Your Ticket was saved and '
+            'will be submitted once the connection is restored.'
+        )
+        msg.exec_()
+        return
+
+    msg.setText('Your Ticket is #%s.' % ticket['id'])
+    view_ticket = msg.addButton('View Ticket', msg.AcceptRole)
+    msg.addButton('Okay', msg.AcceptRole)
+    msg.exec_()
+
+    if msg.clickedButton() == view_ticket:
+        webbrowser.open(app.get_ticket_url(ticket['id']), new=2)
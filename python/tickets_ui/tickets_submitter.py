@@ -3,22 +3,17 @@ from __future__ import print_function
 
 # Standard library imports
 from functools import partial
-import contextlib
-import os
-import shutil
-import tempfile
+import hashlib
 import textwrap
-import traceback
-import webbrowser
+import threading
 
 # Shotgun imports
 import sgtk
 from sgtk.platform.qt import QtCore, QtGui
 
 # Local imports
-from .dialogs import ErrorDialog
 from .notice import Notice
-from . import res
+from . import res, submission
 
 
 app = sgtk.platform.current_bundle()
@@ -56,6 +51,82 @@ def show(app, **field_defaults):
     )
 
 
+class Attachment(object):
+    '''A screen capture stored as compressed image data.
+
+    Only the encoded data is kept once the image has been encoded, the full
+    resolution image is decoded again on demand. Encoding is thread-safe and
+    happens on first access of data, call encode in a background task to do
+    it early. Images larger than max_size are downscaled before encoding.
+    '''
+
+    formats = {
+        'png': ('PNG', 'png'),
+        'jpg': ('JPEG', 'jpg'),
+        'jpeg': ('JPEG', 'jpg'),
+        'webp': ('WEBP', 'webp'),
+    }
+
+    def __init__(self, image, format='png', quality=-1, max_size=0):
+        self.format, self.extension = self.formats.get(
+            format.lower(),
+            self.formats['png'],
+        )
+        self.quality = quality
+        self.max_size = max_size
+        self._image = image
+        self._data = None
+        self._hash = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        '''The encoded image data.'''
+
+        self.encode()
+        return self._data
+
+    @property
+    def hash(self):
+        '''The sha1 hash of the encoded image data.'''
+
+        self.encode()
+        return self._hash
+
+    def encode(self):
+        '''Encode the image and release it. Safe to call from any thread.'''
+
+        with self._lock:
+            if self._data is not None:
+                return
+
+            image = downscale_image(self._image, self.max_size)
+            data = encode_image(image, self.format, self.quality)
+            if data is None:
+                # Format not supported by this Qt build, fallback to PNG
+                self.format, self.extension = self.formats['png']
+                data = encode_image(image, self.format, self.quality)
+            self._data = data
+            self._hash = hashlib.sha1(data).hexdigest()
+            self._image = None
+
+    def to_image(self):
+        '''Decode the full resolution QImage.'''
+
+        with self._lock:
+            if self._image is not None:
+                return QtGui.QImage(self._image)
+
+        image = QtGui.QImage()
+        image.loadFromData(self._data, self.format)
+        return image
+
+    def to_pixmap(self):
+        '''Decode the full resolution QPixmap. Only use in the main thread.'''
+
+        return QtGui.QPixmap.fromImage(self.to_image())
+
+
 class Attachments(QtGui.QListWidget):
     '''Attachments Widget - Horizontal list of screen captures.'''
 
@@ -82,6 +153,7 @@ class Attachments(QtGui.QListWidget):
 
         self._attachments = []
         self._default_items = []
+        self._task_manager = None
 
         # Capture button
         self.capture_button = QtGui.QToolButton(
@@ -95,10 +167,32 @@ class Attachments(QtGui.QListWidget):
         self.setItemWidget(item, self.capture_button)
         self._default_items.append(item)
 
+    def set_bg_task_manager(self, task_manager):
+        '''Set the BackgroundTaskManager used to encode attachments.'''
+
+        self._task_manager = task_manager
+
     def add_attachment(self, pixmap):
+        '''Add a pixmap as an Attachment.
+
+        Only a thumbnail of the pixmap is kept. The image is downscaled and
+        compressed in a background task using the attachment_max_size,
+        attachment_format and attachment_quality settings.
+        '''
+
         size = self.gridSize()
         item = QtGui.QListWidgetItem()
-        item.attachment = pixmap
+        item.attachment = Attachment(
+            pixmap.toImage(),
+            app.get_setting('attachment_format', 'png'),
+            app.get_setting('attachment_quality', -1),
+            app.get_setting('attachment_max_size', 2560),
+        )
+        if self._task_manager:
+            self._task_manager.add_task(
+                item.attachment.encode,
+                group='tickets_attachments',
+            )
         pixmap = pixmap.scaled(
             size,
             QtCore.Qt.KeepAspectRatioByExpanding,
@@ -126,7 +220,7 @@ class Attachments(QtGui.QListWidget):
         item = self.itemAt(pos)
 
         self._preview = QtGui.QLabel()
-        self._preview.setPixmap(item.attachment)
+        self._preview.setPixmap(item.attachment.to_pixmap())
         self._preview.show()
         self._preview.setWindowTitle('Preview')
         self._preview.setWindowIcon(QtGui.QIcon(res.get_path('icon_256.png')))
@@ -180,6 +274,9 @@ class TicketsSubmitter(QtGui.QWidget):
         fields.setdefault('message', None)
         fields.setdefault('assignee', None)
         self._exc_info = fields.pop('exc_info', None)
+        if self._exc_info:
+            # Don't keep the traceback alive while the dialog is open
+            self._exc_info = app.excepthook.snapshot(self._exc_info)
 
         # Initialize widget
         super(TicketsSubmitter, self).__init__(*args, **kwargs)
@@ -190,7 +287,12 @@ class TicketsSubmitter(QtGui.QWidget):
             start_processing=True,
             max_threads=2,
         )
+        self._task_manager.task_completed.connect(self._on_task_completed)
+        self._task_manager.task_failed.connect(self._on_task_failed)
+        self._task_callbacks = {}
+        self._submitted = False
         self._assignee = None
+        self._assignee_name = None
         self._context = None
 
         # Create widgets
@@ -228,11 +330,13 @@ class TicketsSubmitter(QtGui.QWidget):
         self.assignee.completer().entity_activated.disconnect(
             self.assignee.clear
         )
+        self.assignee.editingFinished.connect(self._resolve_assignee)
         self.description = QtGui.QTextEdit(self)
         policy = self.description.sizePolicy()
         policy.setVerticalStretch(1)
         self.description.setSizePolicy(policy)
         self.attachments = Attachments(self)
+        self.attachments.set_bg_task_manager(self._task_manager)
         self.error = QtGui.QTextEdit(self)
         self.error.setFocusPolicy(QtCore.Qt.NoFocus)
         self.error.setTextInteractionFlags(QtCore.Qt.TextBrowserInteraction)
@@ -282,6 +386,11 @@ class TicketsSubmitter(QtGui.QWidget):
 
     def closeEvent(self, event):
         self._task_manager.shut_down()
+
+        # Ask again the next time this exception occurs
+        if self._exc_info and not self._submitted:
+            app.excepthook.forget_ticket(self._exc_info.fingerprint)
+            self._exc_info = None
         event.accept()
 
     def show_field(self, field):
@@ -300,8 +409,36 @@ class TicketsSubmitter(QtGui.QWidget):
         if label:
             label.hide()
 
+    def add_task(self, fn, callback, *args):
+        '''Run fn in a background thread passing the result to callback.
+
+        If the task fails callback is called with None.
+        '''
+
+        task_id = self._task_manager.add_task(
+            fn,
+            group='tickets_submitter',
+            task_args=list(args),
+        )
+        self._task_callbacks[task_id] = callback
+        return task_id
+
+    def _on_task_completed(self, uid, group, result):
+        callback = self._task_callbacks.pop(uid, None)
+        if callback:
+            callback(result)
+
+    def _on_task_failed(self, uid, group, message, stack_trace):
+        callback = self._task_callbacks.pop(uid, None)
+        if callback:
+            app.logger.error('Task failed: %s\n%s' % (message, stack_trace))
+            callback(None)
+
     def set_field_defaults(self, fields):
-        '''Initialize field defaults'''
+        '''Initialize field defaults
+
+        Values that come from Shotgun are loaded in background tasks.
+        '''
 
         # Set context
         context = fields['context'] or app.context
@@ -313,6 +450,7 @@ class TicketsSubmitter(QtGui.QWidget):
         self._assignee = assignee
         if assignee:
             name = assignee.get('name', assignee.get('code', ''))
+            self._assignee_name = name
             self.assignee.setText(name)
 
         # Set title
@@ -339,37 +477,59 @@ class TicketsSubmitter(QtGui.QWidget):
         else:
             self.hide_field(self.error)
 
-        # Set priority values
-        values = app.io.get_priority_values()
-        self.priority.addItems(values)
-        self.priority.setCurrentIndex(self.priority.count() - 1)
-        if fields['priority']:
-            index = self.priority.findText(
-                fields['priority'],
-                QtCore.Qt.MatchFixedString,
-            )
-            if index > -1:
-                self.priority.setCurrentIndex(index)
-
-        # Set type values
-        values = app.io.get_type_values()
-        self.type.addItems(values)
-        if fields['type']:
-            index = self.type.findText(
-                fields['type'],
-                QtCore.Qt.MatchFixedString,
-            )
+        # Set priority and type values
+        self.set_loading(self.priority)
+        self.set_loading(self.type)
+        self.add_task(
+            app.io.get_priority_values,
+            partial(self.set_values, self.priority, fields['priority'], -1),
+        )
+        self.add_task(
+            app.io.get_type_values,
+            partial(self.set_values, self.type, fields['type'], 0),
+        )
+
+    def set_loading(self, combo_box):
+        '''Show a loading placeholder in a combo box.'''
+
+        combo_box.clear()
+        combo_box.addItem('Loading...')
+        combo_box.setEnabled(False)
+        self.submit_button.setEnabled(False)
+
+    def set_values(self, combo_box, default, default_index, values):
+        '''Fill a combo box with values and select the default value.
+
+        When values could not be loaded, only the default value is shown.
+        '''
+
+        combo_box.clear()
+        if values:
+            combo_box.addItems(values)
+        elif default:
+            combo_box.addItem(default)
+        combo_box.setEnabled(True)
+
+        if default_index < 0:
+            default_index += combo_box.count()
+        combo_box.setCurrentIndex(default_index)
+        if default:
+            index = combo_box.findText(default, QtCore.Qt.MatchFixedString)
             if index > -1:
-                self.type.setCurrentIndex(index)
+                combo_box.setCurrentIndex(index)
+
+        if self.priority.isEnabled() and self.type.isEnabled():
+            self.submit_button.setEnabled(True)
 
     def get_fields(self):
+        assignee = self.get_assignee()
         return {
             'title': self.title.text(),
             'description': self.description.toPlainText(),
             'sg_ticket_type': self.type.currentText(),
             'sg_priority': self.priority.currentText(),
             'sg_error': self.error.toPlainText(),
-            'addressings_to': [self.get_assignee()],
+            'addressings_to': [assignee] if assignee else [],
         }
 
     def get_attachments(self):
@@ -379,44 +539,44 @@ class TicketsSubmitter(QtGui.QWidget):
         return self._context
 
     def get_assignee(self):
+        '''Get the assignee entity matching the assignee field's text.
+
+        Assignees typed into the field are looked up by _resolve_assignee.
+        '''
+
         name = self.assignee.text()
-        if not name:
-            # No assignee
+        if not name or name != self._assignee_name:
             return
+        return self._assignee
 
-        # If field text matches _assignee return _assignee
-        if self._assignee:
-            assignee_name = self._assignee.get(
-                'name',
-                self._assignee.get('code', ''),
-            )
-            if assignee_name == name:
-                return self._assignee
-
-        # Else lookup assignee - could be a HumanUser or Group
-        assignee = app.shotgun.find_one(
-            'HumanUser',
-            [['name', 'is', name]],
-            ['id', 'name'],
-        )
-        if assignee:
-            assignee['type'] = 'HumanUser'
-            return assignee
+    def _resolve_assignee(self, callback=None):
+        '''Lookup the assignee typed into the assignee field.
 
-        assignee = app.shotgun.find_one(
-            'Group',
-            [['code', 'is', name]],
-            ['id', 'code'],
-        )
-        if assignee:
-            assignee['type'] = 'Group'
-            return assignee
+        Only assignees that were found are kept, so failed lookups are
+        retried.
+        '''
+
+        name = self.assignee.text()
+        if name == self._assignee_name:
+            if callback:
+                callback(self._assignee)
+            return
+
+        def on_resolved(assignee):
+            if assignee and self.assignee.text() == name:
+                self._assignee = assignee
+                self._assignee_name = name
+            if callback:
+                callback(assignee)
+
+        self.add_task(app.io.find_assignee, on_resolved, name)
 
     def _on_context_changed(self, context):
         self._context = context
 
     def _on_assignee_changed(self, type, id, name):
         self._assignee = {'type': type, 'id': id, 'name': name}
+        self._assignee_name = name
 
     def _on_submit(self):
         fields = self.get_fields()
@@ -445,50 +605,55 @@ class TicketsSubmitter(QtGui.QWidget):
             self.description.setFocus()
             return
 
+        # Wait for the assignee lookup before submitting
+        name = self.assignee.text()
+        if name and name != self._assignee_name:
+            self.submit_button.setEnabled(False)
+            self._resolve_assignee(callback=self._on_assignee_resolved)
+            return
+
+        self._submitted = True
         self.close()
+        submission.submit(fields, context, attachments, self._exc_info)
 
-        try:
-            with tmp_save_pixmaps(attachments) as attachments:
-                ticket = app.create_ticket(
-                    fields=fields,
-                    context=context,
-                    attachments=attachments,
-                    exc_info=self._exc_info,
-                )
-            self._after_submit(ticket)
-        except Exception:
-            app.logger.exception('Error')
-            error_message = ErrorDialog(
-                label='Failed to submit Ticket.',
-                message=traceback.format_exc(),
-                parent=self,
+    def _on_assignee_resolved(self, assignee):
+        self.submit_button.setEnabled(
+            self.priority.isEnabled() and self.type.isEnabled()
+        )
+        if not assignee:
+            note = Notice(
+                'Assignee not found.',
+                fg_color="#EEE",
+                bg_color="#EB5757",
+                parent=self
             )
-            error_message.exec_()
-
-    def _after_submit(self, ticket):
-        msg = QtGui.QMessageBox()
-        msg.setWindowIcon(QtGui.QIcon(res.get_path('icon_256.png')))
-        msg.setWindowTitle('Ticket Submitted')
-        msg.setText('Your Ticket is #%s.' % ticket['id'])
-        view_ticket = msg.addButton('View Ticket', msg.AcceptRole)
-        msg.addButton('Okay', msg.AcceptRole)
-        msg.exec_()
-
-        if msg.clickedButton() == view_ticket:
-            webbrowser.open(app.get_ticket_url(ticket['id']), new=2)
-
-
-@contextlib.contextmanager
-def tmp_save_pixmaps(pixmaps):
-    '''Save pixmaps to a temp directory and return a list of temp files.'''
-
-    tmp_dir = tempfile.mkdtemp()
-    try:
-        tmp_files = []
-        for i, pixmap in enumerate(pixmaps):
-            tmp_file = os.path.join(tmp_dir, 'image{:0>2d}.png'.format(i))
-            pixmap.save(tmp_file)
-            tmp_files.append(tmp_file)
-        yield tmp_files
-    finally:
-        shutil.rmtree(tmp_dir)
+            note.show_top(self)
+            self.assignee.setFocus()
+            return
+
+        if self.assignee.text() == self._assignee_name:
+            self._on_submit()
+
+
+def encode_image(image, format, quality=-1):
+    '''Encode a QImage, returns None if the format is not supported.'''
+
+    buffer = QtCore.QBuffer()
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    if not image.save(buffer, format, quality):
+        return
+    return buffer.data().data()
+
+
+def downscale_image(image, max_size):
+    '''Scale a QImage down to fit within max_size x max_size.'''
+
+    if not max_size or max(image.width(), image.height()) <= max_size:
+        return image
+
+    return image.scaled(
+        max_size,
+        max_size,
+        QtCore.Qt.KeepAspectRatio,
+        QtCore.Qt.SmoothTransformation,
+    )